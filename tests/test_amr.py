@@ -1,5 +1,8 @@
+from collections import Counter
 from pathlib import Path
 
+import pytest
+
 from workbench import semantic
 
 
@@ -17,3 +20,54 @@ def test_parsing():
     print("raw_amrbart_output", raw_amrbart_output)
     trees = semantic.parse_amr_output_file_content(raw_amrbart_output)
     assert len(trees) > 0
+
+
+def test_parsing_sentence_cache():
+    title, content = load_document()
+    first = semantic.run_amr_parsing(title, content)
+    hits = semantic._amr_sentence_cache.hits
+    second = semantic.run_amr_parsing(title, content)
+    assert first == second
+    assert semantic._amr_sentence_cache.hits > hits
+
+
+def test_penman_reader():
+    tree = semantic.parse_penman(
+        '(z0 / want-01 :ARG0 (z1 / boy) :ARG1 (z2 / go-01 :ARG0 z1 :polarity -'
+        ' :quant 3 :op1 "New York"))'
+    )
+    assert tree.name == "z0" and tree.concept == "want-01"
+    go = tree["ARG1"]
+    assert go["ARG0"] == semantic.AMRRef("z1")
+    assert go["polarity"].value == "-"
+    assert go["quant"].value == 3
+    assert go["op1"].value == "New York" and go["op1"].literal
+    with pytest.raises(semantic.AMRSyntaxError):
+        semantic.parse_penman("(z0 / want-01 :ARG0 (z1 / boy)")
+
+
+def test_convert_amrbart_v2_output():
+    with open(Path(__file__).parent / "sample-amr-v2.txt", "r") as f:
+        v2_outputs = [line for line in f.read().splitlines() if line.strip()]
+    amrs = semantic.convert_amrbart_v2_outputs(v2_outputs)
+    for amr in amrs:
+        assert "<pointer:" not in amr and "</AMR>" not in amr
+        semantic.parse_penman(amr)
+    assert semantic.convert_amrbart_v2_output(
+        "( <pointer:0> a :ARG0 ( <pointer:1> b ) ) ) :ARG1 <lit> New York </lit>"
+    ) == '( z0 / a :ARG0 ( z1 / b ) ) :ARG1 "New York"'
+    assert semantic.convert_amrbart_v2_output(
+        "( <pointer:0> a :ARG0 ( <pointer:1> b :ARG1 <pointer:0>"
+    ) == "( z0 / a :ARG0 ( z1 / b :ARG1 z0 ) )"
+
+
+def test_unique_pruning_stats():
+    amrs = ["(a / boy)", "(b / boy)", "(c / girl)", "(d / dog)", "(e / cat)"]
+    stats = Counter()
+    nodes = semantic._unique(
+        (semantic.parse_penman(amr) for amr in amrs), limit=2, stats=stats
+    )
+    assert [node.concept for node in nodes] == ["boy", "girl"]
+    # every candidate that was left out is counted
+    assert stats["duplicates"] + stats["capped"] == len(amrs) - len(nodes)
+    assert stats["capped"] == 2
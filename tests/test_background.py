@@ -0,0 +1,42 @@
+import os
+
+os.environ.setdefault("RPC_CALLER", "1")
+
+from workbench import background
+from workbench.utils import ESCacheError
+
+
+def test_precompute_tokenization_skips_bad_documents(monkeypatch):
+    docs = {
+        "good-1": {"id": "good-1", "title": "A title.", "content": "A sentence."},
+        "good-2": {"id": "good-2", "title": "Another.", "content": "More text."},
+        "unwritable": {"id": "unwritable", "title": "Title.", "content": "Text."},
+    }
+    written = {}
+
+    def get_doc(coll, doc_id):
+        # an unknown document id raises like `get_doc` does on a 404
+        return dict(docs[doc_id])
+
+    def es_writeback(coll, doc_id, key, value, subkey=None):
+        if doc_id == "unwritable":
+            raise ESCacheError("write failed")
+        written[doc_id] = value
+
+    monkeypatch.setattr(background, "get_doc", get_doc)
+    monkeypatch.setattr(background, "es_writeback", es_writeback)
+    background.precompute_tokenization(
+        "testing", ["good-1", "missing", "unwritable", "good-2"]
+    )
+    assert set(written) == {"good-1", "good-2"}
+    assert written["good-1"]["sentences"][0] == ["A", "title", "."]
+
+
+def test_get_tokenization_writeback_failure(monkeypatch):
+    def es_writeback(coll, doc_id, key, value, subkey=None):
+        raise ESCacheError("write failed")
+
+    monkeypatch.setattr(background, "es_writeback", es_writeback)
+    doc = {"id": "doc", "title": "A title.", "content": "A sentence."}
+    tokenization = background.get_tokenization("testing", doc)
+    assert tokenization["sentences"][0] == ["A", "title", "."]
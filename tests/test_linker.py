@@ -0,0 +1,176 @@
+import json
+
+import numpy as np
+
+from workbench import linker
+from workbench.utils import LRUCache
+
+
+def make_hit(entity_id, score):
+    return {
+        "_score": score,
+        "fields": {"entity_id": [entity_id], "aliases": [entity_id], "types": []},
+    }
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def test_query_es_batch(monkeypatch):
+    requests = []
+
+    def es_request(method, path, **kwargs):
+        requests.append((method, path, kwargs))
+        searches = kwargs["data"].splitlines()[1::2]
+        return FakeResponse(
+            {
+                "responses": [
+                    {"hits": {"hits": [make_hit("Q1", 1.0), make_hit("Q2", 0.5)]}},
+                    {},
+                    {"hits": {"hits": [make_hit("Q2", 0.0), make_hit("Q3", 0.0)]}},
+                    {"hits": {"hits": [make_hit("Q4", 0.0)]}},
+                ][: len(searches)]
+            }
+        )
+
+    monkeypatch.setattr(linker, "es_request", es_request)
+    queries = [("Google", "ORG"), ("Edmonton", "GPE")]
+    hits_list = linker.query_es_batch(queries)
+    assert [len(hits) for hits in hits_list] == [2, 0]
+
+    method, path, kwargs = requests[-1]
+    assert path.endswith("/_msearch")
+    assert kwargs["headers"]["Content-Type"] == "application/x-ndjson"
+    assert kwargs["data"].endswith("\n")
+    lines = [json.loads(line) for line in kwargs["data"].splitlines()]
+    assert lines[0::2] == [{}, {}]
+    assert lines[1::2] == [linker._es_entity_query(*query) for query in queries]
+
+    # dense candidates are appended to the lexical hits, without duplicates
+    hits_list = linker.query_es_batch(queries, [["Q2", "Q3"], ["Q4"]])
+    assert [
+        [hit["fields"]["entity_id"][0] for hit in hits] for hits in hits_list
+    ] == [["Q1", "Q2", "Q3"], ["Q4"]]
+    lines = [json.loads(line) for line in requests[-1][2]["data"].splitlines()]
+    assert len(lines) == 8
+
+
+def test_rerank(monkeypatch):
+    rng = np.random.default_rng(0)
+    entity_embeddings = {
+        f"Q{i}": rng.normal(size=8).astype(np.float32) for i in range(5)
+    }
+    monkeypatch.setattr(linker.Models, "get_entity_embedding_matrix", lambda: None)
+    monkeypatch.setattr(
+        linker,
+        "read_entity_embeddings",
+        lambda ids: {x: entity_embeddings[x] for x in ids if x in entity_embeddings},
+    )
+    queued = []
+    monkeypatch.setattr(linker, "queue_entity_embedding_backfill", queued.extend)
+    monkeypatch.setattr(linker, "EMBEDDING_DIM", 8)
+
+    hits_list = [
+        [make_hit("Q0", 1.0), make_hit("Q1", 1.5), make_hit("Q2", 0.2)],
+        [make_hit("Q1", 0.3), make_hit("missing", 2.0)],
+    ]
+    context_embeddings = rng.normal(size=(2, 8)).astype(np.float32)
+    # scores of the per-hit implementation
+    expected = []
+    for hits, embedding in zip(hits_list, context_embeddings):
+        scores = {}
+        for hit in hits:
+            entity_id = hit["fields"]["entity_id"][0]
+            hit_emb = entity_embeddings.get(entity_id, np.zeros(8))
+            scores[entity_id] = max(np.dot(embedding, hit_emb), 0) + hit["_score"] * 3.0
+        expected.append(scores)
+
+    hits_list = linker.rerank(hits_list, context_embeddings)
+    for hits, scores in zip(hits_list, expected):
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        assert [hit["fields"]["entity_id"][0] for hit in hits] == ranked
+        for hit in hits:
+            assert np.isclose(hit["_score"], scores[hit["fields"]["entity_id"][0]])
+    assert queued == ["missing"]
+    provisional = {
+        hit["fields"]["entity_id"][0]: hit["_provisional"]
+        for hits in hits_list
+        for hit in hits
+    }
+    assert provisional == {"Q0": False, "Q1": False, "Q2": False, "missing": True}
+
+
+def test_get_entity_embeddings(monkeypatch):
+    ids = np.array(["Q10", "Q20", "Q30"])
+    vectors = np.arange(3 * 4, dtype=np.float16).reshape(3, 4)
+    stored = {"Q25": np.full(4, 7, dtype=np.float32)}
+    monkeypatch.setattr(
+        linker.Models, "get_entity_embedding_matrix", lambda: (ids, vectors)
+    )
+    monkeypatch.setattr(
+        linker,
+        "read_entity_embeddings",
+        lambda entity_ids: {x: stored[x] for x in entity_ids if x in stored},
+    )
+    queued = []
+    monkeypatch.setattr(linker, "queue_entity_embedding_backfill", queued.extend)
+    monkeypatch.setattr(linker, "EMBEDDING_DIM", 4)
+
+    # before the first id, between two ids, after the last id
+    entity_ids = ["Q30", "Q0", "Q10", "Q25", "Q99", "Q20"]
+    embeddings, provisional = linker.get_entity_embeddings(entity_ids)
+    assert embeddings.dtype == np.float32
+    np.testing.assert_array_equal(embeddings[0], vectors[2])
+    np.testing.assert_array_equal(embeddings[2], vectors[0])
+    np.testing.assert_array_equal(embeddings[3], stored["Q25"])
+    np.testing.assert_array_equal(embeddings[5], vectors[1])
+    np.testing.assert_array_equal(embeddings[[1, 4]], np.zeros((2, 4)))
+    assert provisional.tolist() == [False, True, False, False, True, False]
+    assert queued == ["Q0", "Q99"]
+
+
+def test_exact_search():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(100, 16)).astype(np.float16)
+    queries = rng.normal(size=(5, 16)).astype(np.float32)
+    expected = np.argsort(-(queries @ vectors.astype(np.float32).T), axis=1)[:, :10]
+    # chunks smaller and larger than k
+    for chunk_size in (7, 32, 1000):
+        rows = linker._exact_search(vectors, queries, 10, chunk_size=chunk_size)
+        np.testing.assert_array_equal(rows, expected)
+    assert linker._exact_search(vectors[:3], queries, 10).shape == (5, 3)
+
+
+def test_encode_contexts(monkeypatch):
+    encoded = []
+
+    def encode_sentence(sentences):
+        encoded.extend(sentences)
+        return np.array([[len(sent), 1.0] for sent in sentences], dtype=np.float32)
+
+    monkeypatch.setattr(linker.Models, "encode_sentence", encode_sentence)
+    monkeypatch.setattr(linker, "_context_embedding_cache", LRUCache(maxsize=100))
+    paragraph = [
+        [{"text": "Google"}, {"tokens": ["shuts", "down"]}, {"text": "."}],
+        [{"text": "It"}, {"text": "moves"}, {"text": "."}],
+        [{"text": "Done"}, {"text": "."}],
+    ]
+    sent_indices = [0, 1, 1, 0, 2, 1]
+    embeddings = linker.encode_contexts(paragraph, sent_indices)
+    assert len(encoded) == 3
+    assert embeddings.shape == (len(sent_indices), 2)
+    for i, sent_idx in enumerate(sent_indices):
+        context = linker.mention_context(paragraph, sent_idx)
+        assert embeddings[i][0] == len(context)
+
+    # a repeated call only reads the cache
+    hits = linker._context_embedding_cache.hits
+    again = linker.encode_contexts(paragraph, [2, 0])
+    assert len(encoded) == 3
+    assert linker._context_embedding_cache.hits == hits + 2
+    np.testing.assert_array_equal(again, embeddings[[4, 0]])
@@ -1,6 +1,7 @@
 from pathlib import Path
 
 from workbench import ner
+from workbench.utils import LRUCache
 
 
 def load_document():
@@ -48,3 +49,43 @@ def test_ner():
                 if token.text == "its" and token.entity.text == "Google":
                     pron_resolved = True
     assert pron_resolved
+
+
+def test_ner_micro_batching():
+    from concurrent.futures import ThreadPoolExecutor
+
+    title, content = load_document()
+    sentences, _ = ner.extract_sentences(title, content)
+    documents = [sentences, sentences[:3], sentences[3:]]
+    expected = [ner.run_ner(doc) for doc in documents]
+    # concurrent requests are merged into one batch but results are per request
+    with ThreadPoolExecutor(max_workers=len(documents)) as pool:
+        outputs = list(pool.map(ner.run_ner, documents))
+    assert outputs == expected
+
+
+def test_ner_sentence_cache():
+    title, content = load_document()
+    sentences, _ = ner.extract_sentences(title, content)
+    expected = ner.run_ner(sentences)
+    hits = ner._sentence_cache.hits
+    # the same sentences in another document are served from the cache
+    assert ner.run_ner(sentences) == expected
+    assert ner._sentence_cache.hits - hits == len(sentences)
+
+
+def test_ner_overlong_sentence(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    # sentences must reach the model together, not through the cache
+    monkeypatch.setattr(ner, "_sentence_cache", LRUCache(maxsize=0))
+    title, content = load_document()
+    sentences, _ = ner.extract_sentences(title, content)
+    # short enough in words to share a batch with other sentences, but longer
+    # than the 512 word pieces accepted by the model
+    long_sentence = ["antidisestablishmentarianism"] * 150
+    documents = [sentences, [long_sentence], sentences[:3]]
+    expected = [ner.run_ner(sentences), [[]], ner.run_ner(sentences[:3])]
+    with ThreadPoolExecutor(max_workers=len(documents)) as pool:
+        outputs = list(pool.map(ner.run_ner, documents))
+    assert outputs == expected
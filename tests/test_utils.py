@@ -0,0 +1,181 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from workbench.utils import (
+    LRUCache,
+    MicroBatcher,
+    SQLiteCache,
+    StageTimer,
+    content_hash,
+    log_sampled,
+)
+
+
+def _submit_all(batcher, items):
+    with ThreadPoolExecutor(max_workers=len(items)) as pool:
+        futures = [pool.submit(batcher.submit, item) for item in items]
+        return [future.exception() or future.result() for future in futures]
+
+
+def test_micro_batcher_max_size():
+    batches = []
+
+    def process_batch(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(process_batch, window=0.5, max_size=4, size_of=lambda x: 1)
+    start = time.monotonic()
+    assert _submit_all(batcher, list(range(4))) == [0, 2, 4, 6]
+    # a full batch doesn't wait for the window to close
+    assert time.monotonic() - start < 0.5
+    assert len(batches) == 1 and sorted(batches[0]) == [0, 1, 2, 3]
+
+    batches.clear()
+    assert _submit_all(batcher, list(range(6))) == [0, 2, 4, 6, 8, 10]
+    assert all(len(batch) <= 4 for batch in batches)
+    assert sorted(sum(batches, [])) == list(range(6))
+
+
+def test_micro_batcher_window():
+    batches = []
+
+    def process_batch(items):
+        batches.append(list(items))
+        return items
+
+    batcher = MicroBatcher(process_batch, window=0.05)
+    assert batcher.submit("a") == "a"
+    time.sleep(0.2)
+    assert batcher.submit("b") == "b"
+    assert batches == [["a"], ["b"]]
+
+    batches.clear()
+    assert _submit_all(batcher, ["a", "b", "c"]) == ["a", "b", "c"]
+    assert len(batches) == 1
+
+
+def test_micro_batcher_exceptions():
+    def process_batch(items):
+        raise ValueError("failed")
+
+    batcher = MicroBatcher(process_batch, window=0.2)
+    results = _submit_all(batcher, ["a", "b", "c"])
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_micro_batcher_isolates_failures():
+    batches = []
+
+    def process_batch(items):
+        batches.append(list(items))
+        if "bad" in items:
+            raise ValueError("bad item")
+        return [item.upper() for item in items]
+
+    batcher = MicroBatcher(process_batch, window=0.2)
+    items = ["a", "bad", "b"]
+    results = _submit_all(batcher, items)
+    assert results[0] == "A" and results[2] == "B"
+    assert isinstance(results[1], ValueError)
+    # the merged batch failed, then each item was retried alone
+    assert sorted(batches[0]) == sorted(items)
+    assert sorted(map(tuple, batches[1:])) == [("a",), ("b",), ("bad",)]
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    # "b" is the least recently used one
+    assert "b" not in cache
+    assert cache.get("b", "missing") == "missing"
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    cache.put("a", 4)
+    cache.put("d", 5)
+    assert "c" not in cache and cache.get("a") == 4
+
+    disabled = LRUCache(maxsize=0)
+    disabled.put("a", 1)
+    assert "a" not in disabled
+
+
+def test_sqlite_cache(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = SQLiteCache(path, "entries", maxsize=1)
+    cache.put("a", [[0, 1, "PER"]])
+    cache.put_many([("b", []), ("c", [[2, 3, "ORG"]])])
+    assert "a" not in cache  # evicted from memory, still stored
+    assert cache.get("a") == [[0, 1, "PER"]]
+    assert cache.get("missing") is None
+
+    # entries outlive the instance
+    reopened = SQLiteCache(path, "entries")
+    assert reopened.get("b") == [] and reopened.get("c") == [[2, 3, "ORG"]]
+    assert (reopened.hits, reopened.misses) == (2, 0)
+
+    # an unusable database only disables the persistent part
+    broken = SQLiteCache(str(tmp_path / "missing" / "cache.sqlite3"), "entries")
+    broken.put("a", 1)
+    assert broken.get("a") == 1 and broken.get("b") is None
+
+
+def test_content_hash():
+    assert content_hash("text", [1, 2]) == content_hash("text", [1, 2])
+    assert content_hash("text", [1, 2]) != content_hash("text", [2, 1])
+    assert content_hash("ab", "c") != content_hash("a", "bc")
+    # the value is persisted in caches, so it must not change between releases
+    assert content_hash("text") == "560a1db48bf7462862f3806d705f8b1573581017"
+
+
+def test_stage_timer(caplog):
+    timer = StageTimer("test")
+    with timer("load", items=3):
+        time.sleep(0.01)
+    with timer("load", items=2):
+        pass
+    with pytest.raises(ValueError):
+        with timer("parse"):
+            raise ValueError()
+    snapshot = timer.snapshot()
+    assert list(snapshot) == ["load", "parse"]
+    assert snapshot["load"]["items"] == 5 and snapshot["parse"]["items"] == 1
+    assert snapshot["load"]["seconds"] >= 0.01
+
+    logger = logging.getLogger("test_stage_timer")
+    with caplog.at_level(logging.INFO, logger=logger.name):
+        timer.log(logger)
+        timer.log(logger, logging.DEBUG)
+    assert len(caplog.records) == 1
+    assert "test timings" in caplog.text and "load" in caplog.text
+
+    since = timer.snapshot()
+    with timer("parse", items=4):
+        pass
+    caplog.clear()
+    with caplog.at_level(logging.INFO, logger=logger.name):
+        timer.log(logger, since=since)
+    # only the stages used after the snapshot, with their new items
+    assert "parse" in caplog.text and "/4" in caplog.text
+    assert "load" not in caplog.text
+
+
+def test_log_sampled(caplog):
+    logger = logging.getLogger("test_log_sampled")
+    with caplog.at_level(logging.DEBUG, logger=logger.name):
+        log_sampled(logger, 1.0, "always %d", 1)
+        log_sampled(logger, 0.0, "never %d", 2)
+    assert [r.getMessage() for r in caplog.records] == ["always 1"]
+
+    caplog.clear()
+    with caplog.at_level(logging.INFO, logger=logger.name):
+        log_sampled(logger, 1.0, "debug disabled")
+    assert not caplog.records
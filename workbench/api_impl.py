@@ -3,8 +3,10 @@ Implementations of APIs
 """
 
 from functools import lru_cache
+import logging
 import random
 import base64
+import json
 
 from flask import g
 from newspaper import Article
@@ -14,11 +16,20 @@ from .ner import resolve_coreferences, run_ner, extract_sentences, parse_raw_ner
 from .linker import run_linker
 from .semantic import (
     parse_amr_output_file_content,
+    parse_amr_output_file_content_cached,
     extract_person_relations_from_amr_content,
     run_amr_parsing,
 )
 from .vader import run_vader
-from .utils import es_request, es_cache, fix_es_news
+from .utils import (
+    es_request,
+    es_cache,
+    es_writeback,
+    fix_es_news,
+    dictify,
+    content_hash,
+    ESCacheError,
+)
 from .relation_extraction import run_rel
 from .bing_search import search_news, search_webpage
 from .classifier import (
@@ -67,10 +78,17 @@ def list_collections(detailed: bool = False):
         return [x["name"] for x in collections]
 
 
-def tokenize():
+@es_cache(key=Config.CacheKeys.tokenization)
+def _get_tokenization():
     document = g.doc
+    sentences, pos = extract_sentences(document["title"], document["content"])
+    return {"sentences": sentences, "pos": pos}
+
+
+def tokenize():
     if "sentences" not in g:
-        g.sentences, g.pos = extract_sentences(document["title"], document["content"])
+        tokenization = _get_tokenization()
+        g.sentences, g.pos = tokenization["sentences"], tokenization["pos"]
 
 
 @es_cache(key=Config.CacheKeys.raw_pure_ner_output)
@@ -100,7 +118,12 @@ def extract_relations():
     return output
 
 
-@es_cache(key=Config.CacheKeys.linker_output)
+def _is_final_linker_output(candidates):
+    # rankings using backfilled entity embeddings change once they're computed
+    return not any(candidate["provisional"] for candidate in candidates)
+
+
+@es_cache(key=Config.CacheKeys.linker_output, should_cache=_is_final_linker_output)
 def get_linker_output(sent_idx, mention_idx):
     paragraph = get_ner()
     mention = paragraph[sent_idx][mention_idx]
@@ -142,20 +165,102 @@ def download_article_from_web(url):
 @es_cache(key=Config.CacheKeys.amr_output)
 def parse_or_read_cached_amr():
     news = g.doc
-    amr_output_content = run_amr_parsing.delay(news["title"], news["content"]).get()
+    tokenize()
+    amr_output_content = run_amr_parsing.delay(
+        news["title"], news["content"], sentences=g.sentences
+    ).get()
     return amr_output_content
 
 
-def semantic_parse_document():
+@es_cache(key=Config.CacheKeys.amr_graphs)
+def _get_amr_graphs_json():
     amr_output_content = parse_or_read_cached_amr()
-    output = parse_amr_output_file_content(
-        amr_output_content, should_simplify_graph=True
+    # parsed once, the graphs are cached in elasticsearch
+    output = list(
+        _graph_items(
+            parse_amr_output_file_content(
+                amr_output_content, should_simplify_graph=True
+            )
+        )
     )
-    output = [
-        {"sentence": sent, "nodes": graph.nodes, "edges": graph.edges}
-        for sent, graph in output
+    # stored as a string: constant values mix numbers and strings, which can't
+    # share a field mapping in elasticsearch
+    return json.dumps(dictify(output))
+
+
+def semantic_parse_document():
+    return json.loads(_get_amr_graphs_json())
+
+
+def _graph_items(sents_and_graphs):
+    for sent, graph in sents_and_graphs:
+        yield {"sentence": sent, "nodes": graph.nodes, "edges": graph.edges}
+
+
+def semantic_parse_document_stream():
+    """
+    Yield the items of `semantic_parse_document` as soon as the sentences are
+    decoded, `Config.amr_stream_chunk_size` sentences at a time.
+    The AMR output decoded so far is cached under `CacheKeys.amr_output_partial`,
+    an interrupted stream resumes from there.
+    """
+    doc = g.doc
+    if Config.CacheKeys.amr_output in doc and not g.bypass_cache:
+        yield from semantic_parse_document()
+        return
+
+    tokenize()
+    sentences = g.sentences
+    key = content_hash(sentences, Config.CacheKeys.amr_output)
+    partial = doc.get(Config.CacheKeys.amr_output_partial) or {}
+    if partial.get("key") != key or g.bypass_cache:
+        partial = {"key": key, "sentences": 0, "content": ""}
+    if partial["content"]:
+        # parsed again by every resumed request until more sentences are decoded
+        yield from _graph_items(
+            parse_amr_output_file_content_cached(
+                partial["content"], should_simplify_graph=True
+            )
+        )
+
+    chunk_size = Config.amr_stream_chunk_size
+    # all chunks are queued at once, results are read back in order. Only the
+    # sentences of a chunk are sent, they replace the document title and content
+    tasks = [
+        run_amr_parsing.delay("", "", sentences=sentences[i : i + chunk_size])
+        for i in range(partial["sentences"], len(sentences), chunk_size)
     ]
-    return output
+    for task in tasks:
+        chunk_output = task.get()
+        yield from _graph_items(
+            parse_amr_output_file_content(chunk_output, should_simplify_graph=True)
+        )
+        if partial["content"]:
+            partial["content"] += "\n"
+        partial["content"] += chunk_output
+        partial["sentences"] = min(partial["sentences"] + chunk_size, len(sentences))
+        try:
+            es_writeback(
+                g.collection, doc["id"], Config.CacheKeys.amr_output_partial, partial
+            )
+        except ESCacheError:
+            logging.error("Failed to cache partial AMR output of %s", doc["id"])
+
+    try:
+        es_writeback(
+            g.collection, doc["id"], Config.CacheKeys.amr_output, partial["content"]
+        )
+    except ESCacheError:
+        logging.error("Failed to cache AMR output of %s", doc["id"])
+    else:
+        # the complete output is cached, the partial one is no longer needed
+        try:
+            es_writeback(
+                g.collection, doc["id"], Config.CacheKeys.amr_output_partial, None
+            )
+        except ESCacheError:
+            logging.error("Failed to clear partial AMR output of %s", doc["id"])
+    doc[Config.CacheKeys.amr_output] = partial["content"]
 
 
 @es_cache(key=Config.CacheKeys.person_rel_output)
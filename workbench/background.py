@@ -10,12 +10,23 @@ import os
 assert os.environ["RPC_CALLER"] == "1"
 
 import networkx as nx
-from celery import group
 from celery.result import allow_join_result
 
-from .ner import resolve_coreferences, run_ner, parse_raw_ner_output, extract_sentences
-from .linker import follow_coreference, run_linker
-from .semantic import run_amr_parsing, extract_person_relations_from_amr_content
+from .ner import (
+    resolve_coreferences,
+    run_ner,
+    parse_raw_ner_output,
+    extract_sentences,
+    extract_sentences_batch,
+)
+from .linker import follow_coreference, run_linker_batch
+from .semantic import (
+    run_amr_parsing,
+    run_amr_to_text,
+    extract_person_relation_graphs,
+    lookup_amr_to_text,
+    store_amr_to_text,
+)
 from .vader import run_vader
 from .relation_extraction import run_rel
 from .utils import es_request, es_writeback, dictify
@@ -38,13 +49,56 @@ def get_doc(collection, doc_id):
     return fix_es_news(r["_source"])
 
 
+def get_tokenization(coll, doc):
+    """
+    Read the tokenization artifact of `doc`, computing and caching it if missing.
+    A failed writeback is only logged, the tokenization is still returned.
+    """
+    tokenization = doc.get(Config.CacheKeys.tokenization)
+    if tokenization is None:
+        sentences, pos = extract_sentences(doc["title"], doc["content"])
+        tokenization = {"sentences": sentences, "pos": pos}
+        try:
+            es_writeback(coll, doc["id"], Config.CacheKeys.tokenization, tokenization)
+        except Exception:
+            logging.exception("Failed to save tokenization of doc %s", doc["id"])
+    return tokenization
+
+
+@celery.task
+def precompute_tokenization(coll, doc_ids):
+    """
+    Tokenize many documents with one spaCy pass, skipping those already tokenized.
+    Best-effort: a document that can't be read or written back is skipped, its own
+    tasks tokenize it again with `get_tokenization`.
+    """
+    logging.info("precompute_tokenization")
+    docs = []
+    for doc_id in doc_ids:
+        try:
+            doc = get_doc(coll, doc_id)
+        except Exception:
+            logging.exception("Failed to read doc %s, not tokenizing it", doc_id)
+            continue
+        if Config.CacheKeys.tokenization not in doc:
+            docs.append(doc)
+    outputs = extract_sentences_batch([(doc["title"], doc["content"]) for doc in docs])
+    for doc, (sentences, pos) in zip(docs, outputs):
+        tokenization = {"sentences": sentences, "pos": pos}
+        try:
+            es_writeback(coll, doc["id"], Config.CacheKeys.tokenization, tokenization)
+        except Exception:
+            logging.exception("Failed to save tokenization of doc %s", doc["id"])
+
+
 @celery.task
 def precompute_ner(coll, doc_id):
     doc = get_doc(coll, doc_id)
+    tokenization = get_tokenization(coll, doc)
+    sentences, pos = tokenization["sentences"], tokenization["pos"]
     # OPTIMIZE: better use celery.chain here.
-    sentences, pos = extract_sentences(doc["title"], doc["content"])
     with allow_join_result():
-        raw_ner_output = run_ner.apply_async(args=(sentences), priority=0).get()
+        raw_ner_output = run_ner.apply_async(args=(sentences,), priority=0).get()
     es_writeback(coll, doc_id, Config.CacheKeys.raw_pure_ner_output, raw_ner_output)
     ner_output = parse_raw_ner_output(sentences, pos, raw_ner_output)
     ner_output = resolve_coreferences(ner_output)
@@ -80,12 +134,14 @@ def precompute_linker(coll, doc_id):
             unique_mentions.add(task)
     unique_mentions = list(unique_mentions)
     logging.info("Unique mentions: %s", unique_mentions)
-    linker_tasks = group(
-        *[run_linker.si(paragraph, paragraph[x[0]][x[1]]) for x in unique_mentions]
-    )
+    mentions = [paragraph[x[0]][x[1]] for x in unique_mentions]
     # OPTIMIZE: better use celery.chain here.
     with allow_join_result():
-        linker_outputs = linker_tasks.delay().get()
+        linker_outputs = run_linker_batch.apply_async(
+            args=(paragraph, mentions),
+            kwargs={"compute_missing": True},
+            priority=0,
+        ).get()
     cache_item = {}
     for mention, output in zip(unique_mentions, linker_outputs):
         cache_item[f"||arg0:{mention[0]}||arg1:{mention[1]}"] = output
@@ -100,27 +156,65 @@ def precompute_linker(coll, doc_id):
 def precompute_amr(coll, doc_id):
     logging.info("precompute_amr")
     doc = get_doc(coll, doc_id)
+    sentences = get_tokenization(coll, doc)["sentences"]
     # OPTIMIZE: better use celery.chain here.
     with allow_join_result():
-        amr_output = run_amr_parsing.delay(doc["title"], doc["content"]).get()
+        amr_output = run_amr_parsing.delay(
+            doc["title"], doc["content"], sentences=sentences
+        ).get()
     es_writeback(coll, doc_id, Config.CacheKeys.amr_output, dictify(amr_output))
     return amr_output
 
 
 @celery.task
 def precompute_person_rel(coll, doc_id):
+    """
+    Runs as a chain of stages (AMR parsing, subgraph extraction, AMR2Text,
+    writeback), each stage passes its result to the next one without blocking.
+    """
     logging.info("precompute_person_rel")
     doc = get_doc(coll, doc_id)
     amr_output = doc.get(Config.CacheKeys.amr_output)
     if amr_output is None:
         logging.info("amr output not available for doc %s, precomputing", doc_id)
-        # OPTIMIZE: better use celery.chain here.
-        with allow_join_result():
-            amr_output = precompute_amr.delay(coll, doc_id).get()
-    # OPTIMIZE: better use celery.chain here.
-    with allow_join_result():
-        outputs = extract_person_relations_from_amr_content(amr_output)
-    relations = [{"sent": x[0], "rel_text": x[1]} for x in outputs]  # ignore subgraphs
+        sentences = get_tokenization(coll, doc)["sentences"]
+        pipeline = (
+            run_amr_parsing.si(
+                doc["title"], doc["content"], sentences=sentences
+            ).set(queue="amr_parsing", priority=0)
+            | save_amr_output.s(coll, doc_id).set(queue="background", priority=0)
+            | extract_person_rel.s(coll, doc_id).set(queue="background", priority=0)
+        )
+        pipeline.delay()
+    else:
+        extract_person_rel(amr_output, coll, doc_id)
+
+
+@celery.task
+def save_amr_output(amr_output, coll, doc_id):
+    es_writeback(coll, doc_id, Config.CacheKeys.amr_output, dictify(amr_output))
+    return amr_output
+
+
+@celery.task
+def extract_person_rel(amr_output, coll, doc_id):
+    sents, rel_graphs = extract_person_relation_graphs(amr_output)
+    keys, texts, to_generate = lookup_amr_to_text(rel_graphs)
+    if not to_generate:
+        save_person_rel([], coll, doc_id, sents, keys, texts, [])
+        return
+    generate = run_amr_to_text.si(list(to_generate.values()))
+    generate.set(queue="amr2text", priority=0)
+    # the generated texts are passed as the first argument of save_person_rel
+    save = save_person_rel.s(coll, doc_id, sents, keys, texts, list(to_generate))
+    save.set(queue="background", priority=0)
+    (generate | save).delay()
+
+
+@celery.task
+def save_person_rel(generated, coll, doc_id, sents, keys, texts, generated_keys):
+    texts = store_amr_to_text(keys, texts, generated_keys, generated)
+    relations = [{"sent": sent, "rel_text": text} for sent, text in zip(sents, texts)]
     es_writeback(coll, doc_id, Config.CacheKeys.person_rel_output, dictify(relations))
 
 
@@ -230,6 +324,9 @@ name_to_celery_task = {
 
 parent_tasks = {"linker": ["ner"], "person_rel": ["amr"], "relation": ["ner"]}
 
+# tasks reading the tokenization artifact
+tokenized_tasks = {"ner", "amr"}
+
 
 full_dep_graph = nx.DiGraph()
 for task in name_to_celery_task:
@@ -238,6 +335,16 @@ for task, deps in parent_tasks.items():
     for dep in deps:
         full_dep_graph.add_edge(dep, task)
 
+
+def needs_tokenization(required_tasks):
+    for task in required_tasks:
+        if task in tokenized_tasks:
+            return True
+        if nx.ancestors(full_dep_graph, task) & tokenized_tasks:
+            return True
+    return False
+
+
 if __name__ == "__main__":
     celery.start(
         argv=[
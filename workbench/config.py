@@ -9,26 +9,114 @@ def p(path):
 
 class Config:
     embeddings_db = "/app/db/embeddings.sqlite3"
+    # read-only copy of `embeddings_db` used by the linker, built with
+    # `python -m workbench.linker build-embedding-matrix`
+    entity_embedding_matrix = os.environ.get(
+        "ENTITY_EMBEDDING_MATRIX", "/app/db/entity_embeddings.npy"
+    )
+    entity_embedding_ids = os.environ.get(
+        "ENTITY_EMBEDDING_IDS", "/app/db/entity_embedding_ids.npy"
+    )
+    entity_embedding_dtype = os.environ.get("ENTITY_EMBEDDING_DTYPE", "float16")
+    # entities per Neo4j description lookup and encoder call when computing
+    # missing embeddings
+    entity_embedding_batch_size = int(
+        os.environ.get("ENTITY_EMBEDDING_BATCH_SIZE", 256)
+    )
+    # HNSW index over the matrix (needs faiss-cpu), built with
+    # `python -m workbench.linker build-ann-index`
+    entity_ann_index = os.environ.get(
+        "ENTITY_ANN_INDEX", "/app/db/entity_embeddings.hnsw"
+    )
+    entity_ann_hnsw_m = int(os.environ.get("ENTITY_ANN_HNSW_M", 32))
+    entity_ann_ef_search = int(os.environ.get("ENTITY_ANN_EF_SEARCH", 64))
+    # entities closest to the mention context added to the linker candidates,
+    # 0 to only use lexical (alias) matches
+    linker_dense_candidates = int(os.environ.get("LINKER_DENSE_CANDIDATES", 0))
+    # number of mention context embeddings kept in memory by each linker worker
+    linker_context_cache_size = int(
+        os.environ.get("LINKER_CONTEXT_CACHE_SIZE", 10000)
+    )
 
     neo4j_url = "bolt://neo4j:7687"
     neo4j_auth = ("neo4j", "wdmuofa")
 
+    # SpaCy sentence segmentation. n_process > 1 can't be used inside
+    # (daemonic) prefork celery workers
+    spacy_n_process = int(os.environ.get("SPACY_N_PROCESS", 1))
+    spacy_batch_size = int(os.environ.get("SPACY_BATCH_SIZE", 64))
+    # batch jobs tokenize this many documents per task, each group of documents
+    # starts its other tasks as soon as its own tokenization is done
+    tokenization_chunk_size = int(os.environ.get("TOKENIZATION_CHUNK_SIZE", 64))
+
     # PURE configuration
     ner_script = p("thirdparty/pure-ner/run_ner.py")
     ner_script_entrypoint = "call"
+    ner_engine_entrypoint = "create_engine"
+    # run_ner requests arriving within `ner_batch_window` seconds are run as one
+    # batch, up to `ner_batch_max_tokens` tokens (a larger document runs alone)
+    ner_batch_window = float(os.environ.get("NER_BATCH_WINDOW", 0.05))
+    ner_batch_max_tokens = int(os.environ.get("NER_BATCH_MAX_TOKENS", 16384))
+    ner_worker_concurrency = int(os.environ.get("NER_WORKER_CONCURRENCY", 8))
+    # skip candidate spans containing punctuation (faster, may miss some entities)
+    ner_prune_spans = os.environ.get("NER_PRUNE_SPANS", "0") == "1"
+    # number of sentences (with their context) whose NER output is kept in memory
+    ner_sentence_cache_size = int(os.environ.get("NER_SENTENCE_CACHE_SIZE", 100000))
+    # all NER outputs are also stored here, kept across restarts. Empty: memory only
+    ner_sentence_cache_db = os.environ.get(
+        "NER_SENTENCE_CACHE_DB", "/app/db/ner_sentences.sqlite3"
+    )
     ner_model = p("thirdparty/ent-bert-ctx300")
     rel_script = p("thirdparty/pure-ner/run_relation.py")
     rel_script_entrypoint = "call_from_external"
     rel_model = p("thirdparty/rel-bert-ctx100")
 
     # AMR parsing
-    amr_script = p("thirdparty/amrbart/fine-tune/main.py")
-    amr_script_entrypoint = "main"
+    amr_script = p("thirdparty/amrbart/fine-tune/generator.py")
+    amr_script_entrypoint = "AMRBartGenerator"
     amr_model = p("thirdparty/AMRBART-large-finetuned-AMR3.0-AMRParsing")
+    # number of sentences whose AMRBART output is kept in memory
+    amr_sentence_cache_size = int(os.environ.get("AMR_SENTENCE_CACHE_SIZE", 20000))
+    # AMR generation batches: sentences of similar lengths are decoded together
+    amr_max_batch_size = int(os.environ.get("AMR_MAX_BATCH_SIZE", 32))
+    # padded source tokens * beams
+    amr_max_batch_tokens = int(os.environ.get("AMR_MAX_BATCH_TOKENS", 6000))
+    # "len:beams,len:beams", e.g. "16:3,32:4": sentences of at most 16 subword
+    # tokens use 3 beams, ... longer sentences use 5 beams
+    amr_beam_schedule = [
+        tuple(int(x) for x in item.split(":"))
+        for item in os.environ.get("AMR_BEAM_SCHEDULE", "").split(",")
+        if item
+    ]
+    # max target length of a batch: min(768, a + k * longest source length)
+    amr_length_cap = (
+        int(os.environ.get("AMR_LENGTH_CAP_BASE", 128)),
+        float(os.environ.get("AMR_LENGTH_CAP_RATIO", 8)),
+    )
+    # level of the workbench.semantic logger, and the fraction of per-sentence
+    # debug messages that are logged
+    amr_log_level = os.environ.get("AMR_LOG_LEVEL", "INFO")
+    amr_debug_sample_rate = float(os.environ.get("AMR_DEBUG_SAMPLE_RATE", 0.01))
+    # sentences decoded per request when /semantic results are streamed. Smaller
+    # chunks show the first graphs sooner, larger ones fill the decoding batches
+    # (up to `amr_max_batch_size`) and finish the whole document faster
+    amr_stream_chunk_size = int(os.environ.get("AMR_STREAM_CHUNK_SIZE", 16))
+    # number of documents whose parsed AMR graphs are kept in memory
+    amr_graph_cache_size = int(os.environ.get("AMR_GRAPH_CACHE_SIZE", 256))
+    # person relation subgraphs sent to AMR2Text, per sentence
+    person_relation_max_subgraphs = int(
+        os.environ.get("PERSON_RELATION_MAX_SUBGRAPHS", 32)
+    )
+    # alternatives (e.g. operands of `and`) expanded per kept edge
+    person_relation_max_alternatives = int(
+        os.environ.get("PERSON_RELATION_MAX_ALTERNATIVES", 8)
+    )
     # AMR2Text
-    amr2text_script = p("thirdparty/amrbart/fine-tune/main.py")
-    amr2text_script_entrypoint = "main"
+    amr2text_script = p("thirdparty/amrbart/fine-tune/generator.py")
+    amr2text_script_entrypoint = "AMRBartGenerator"
     amr2text_model = p("thirdparty/AMRBART-large-finetuned-AMR3.0-AMR2Text")
+    # number of subgraphs whose AMR2Text output is kept in memory
+    amr2text_cache_size = int(os.environ.get("AMR2TEXT_CACHE_SIZE", 50000))
 
     # Classifiers
     crime_multiclass_model = "/app/models/final_model_SVM2.pkl"
@@ -47,6 +135,7 @@ class Config:
     default_bing_api_key = os.environ.get("BING_KEY")
 
     class CacheKeys:
+        tokenization = "tokenization-v1"  # {"sentences": [[token]], "pos": [[pos]]}
         raw_pure_ner_output = "raw-pure-ner-output"
         ner_output = "ner-output"
         linker_output = "raw-linker-output"
@@ -54,6 +143,9 @@ class Config:
             "linker-output-full"  # flag indicating if all mentions are linked
         )
         amr_output = "raw-amr-output-v2"
+        amr_graphs = "amr-graphs-v1"  # JSON string of the /semantic output
+        # AMR output of the first sentences of a document, while it's streamed
+        amr_output_partial = "raw-amr-output-v2-partial"
         person_rel_output = "raw-person-rel-output-v2"
         vader_output = "vader-output"
         re_output = "re-output-v3"
@@ -1,7 +1,10 @@
 from typing import *
 from dataclasses import dataclass
+import json
 import logging
-import sqlite3
+import os
+import sys
+import time
 
 from .config import Config
 
@@ -11,13 +14,11 @@ try:
 
     neo4j = GraphDatabase.driver(Config.neo4j_url, auth=Config.neo4j_auth)
 except ImportError as e:
-    import os
-
     if os.environ.get("RPC_CALLER") is None:
         raise e
 
 from .ner import EntityMention
-from .utils import es_request, Models, asdict
+from .utils import es_request, Models, LRUCache, asdict, content_hash
 from .rpc import create_celery
 
 celery = create_celery("workbench.linker", "linker")
@@ -28,6 +29,8 @@ class Candidate:
     entity_id: str
     score: float
     names: List[str]
+    # the entity embedding is being backfilled, `score` is by name match only
+    provisional: bool = False
 
     def asdict(self):
         return asdict(self)
@@ -45,8 +48,8 @@ def sentence_to_string(sent) -> str:
     return " ".join(parts)
 
 
-def query_es(name: str, mention_type: str) -> List[Dict]:
-    query = {
+def _es_entity_query(name: str, mention_type: str) -> Dict:
+    return {
         "query": {
             "bool": {
                 "must": {"match": {"name": name}},
@@ -57,74 +60,507 @@ def query_es(name: str, mention_type: str) -> List[Dict]:
         "fields": ["aliases", "entity_id", "types"],
         "_source": False,
     }
+
+
+def query_es(name: str, mention_type: str) -> List[Dict]:
+    query = _es_entity_query(name, mention_type)
     r = es_request("GET", f"/{Config.es_entity_collection}/_search", json=query).json()
     if "hits" not in r or "hits" not in r["hits"]:
         return []
     return r["hits"]["hits"]
 
 
-def compute_entity_embedding(entityId: str):
-    logging.info("Computing entity embedding on the fly")
+def _es_entity_id_query(name: str, mention_type: str, entity_ids: List[str]) -> Dict:
+    # `name` only contributes to the score, entities are selected by id
+    return {
+        "size": len(entity_ids),
+        "query": {
+            "bool": {
+                "should": {"match": {"name": name}},
+                "filter": [
+                    {"terms": {"entity_id": entity_ids}},
+                    {"term": {"types": mention_type.lower()}},
+                ],
+            }
+        },
+        "collapse": {"field": "entity_id"},
+        "fields": ["aliases", "entity_id", "types"],
+        "_source": False,
+    }
+
+
+def _msearch(searches: List[Dict]) -> List[List[Dict]]:
+    if len(searches) == 0:
+        return []
+    lines = []
+    for search in searches:
+        lines.append(json.dumps({}))
+        lines.append(json.dumps(search))
+    r = es_request(
+        "GET",
+        f"/{Config.es_entity_collection}/_msearch",
+        data="\n".join(lines) + "\n",
+        headers={"Content-Type": "application/x-ndjson"},
+    ).json()
+    responses = r.get("responses", [])
+    if len(responses) != len(searches):
+        logging.warning("Unexpected _msearch response: %s", r)
+        responses = [{}] * len(searches)
+    results = []
+    for response in responses:
+        if "hits" not in response or "hits" not in response["hits"]:
+            results.append([])
+        else:
+            results.append(response["hits"]["hits"])
+    return results
+
+
+def query_es_batch(
+    queries: List[Tuple[str, str]], dense_candidates: List[List[str]] = None
+) -> List[List[Dict]]:
+    """
+    `query_es` for many (name, mention_type) pairs with a single `_msearch`.
+    `dense_candidates`: entity ids per query (see `search_entity_embeddings`),
+    those of the right type are appended to the lexical hits.
+    """
+    searches = [_es_entity_query(name, mention_type) for name, mention_type in queries]
+    if dense_candidates is None:
+        return _msearch(searches)
+    searches.extend(
+        _es_entity_id_query(name, mention_type, entity_ids)
+        for (name, mention_type), entity_ids in zip(queries, dense_candidates)
+    )
+    results = _msearch(searches)
+    lexical_results, dense_results = results[: len(queries)], results[len(queries) :]
+    hits_list = []
+    for lexical_hits, dense_hits in zip(lexical_results, dense_results):
+        lexical_ids = {hit["fields"]["entity_id"][0] for hit in lexical_hits}
+        hits_list.append(
+            lexical_hits
+            + [
+                hit
+                for hit in dense_hits
+                if hit["fields"]["entity_id"][0] not in lexical_ids
+            ]
+        )
+    return hits_list
+
+
+# multi-qa-mpnet-base-dot-v1, used for entities without description
+EMBEDDING_DIM = 768
+
+# entities whose embeddings were recently queued for backfill by this worker
+_backfill_queued = LRUCache(maxsize=100000)
+
+# embeddings of recently encoded mention contexts, by hash of the context string
+_context_embedding_cache = LRUCache(maxsize=Config.linker_context_cache_size)
+
+
+def get_entity_descriptions(entity_ids: List[str]) -> Dict[str, str]:
+    """
+    Wiki abstract, or description if there's no abstract, of each entity that has
+    one, with one Neo4j query.
+    """
+    abstracts, descriptions = {}, {}
     with neo4j.session() as session:
-        desc = ""  # can't compute entity embedding if there's no wiki abstract or description
-        row = session.run(
-            "MATCH (e: Entity) -[:WIKI_ABSTRACT]-> (wiki: WikiAbstract) WHERE e.entityId = $entity_id RETURN wiki.abstract AS abstract",
-            entity_id=entityId,
-        ).single()
-        if row:
-            desc = row["abstract"]
-        if not desc:
-            row = session.run(
-                "MATCH (e: Entity) WHERE e.entityId = $entity_id RETURN e.desc AS desc",
-                entity_id=entityId,
-            ).single()
-            if row:
-                desc = row["desc"]
-                if type(desc) == list:
-                    desc = desc[0]
-    if desc:
-        logging.info("Got entity description")
-        emb = Models.encode_sentence(desc)
+        rows = session.run(
+            """
+            UNWIND $ids AS entity_id
+            MATCH (e: Entity) WHERE e.entityId = entity_id
+            OPTIONAL MATCH (e) -[:WIKI_ABSTRACT]-> (wiki: WikiAbstract)
+            RETURN entity_id, wiki.abstract AS abstract, e.desc AS desc
+            """,
+            ids=entity_ids,
+        )
+        for row in rows:
+            if row["abstract"]:
+                abstracts.setdefault(row["entity_id"], row["abstract"])
+            desc = row["desc"]
+            if type(desc) == list:
+                desc = desc[0] if desc else None
+            if desc:
+                descriptions.setdefault(row["entity_id"], desc)
+    descriptions.update(abstracts)
+    return descriptions
+
+
+def compute_entity_embeddings(entity_ids: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Encode the descriptions of `entity_ids` in batches and store the embeddings in
+    SQLite. Entities without description get a zero embedding, so they are not
+    looked up again.
+    """
+    embeddings = {}
+    batch_size = Config.entity_embedding_batch_size
+    for start in range(0, len(entity_ids), batch_size):
+        batch_ids = entity_ids[start : start + batch_size]
+        descriptions = get_entity_descriptions(batch_ids)
+        vectors = np.zeros((len(batch_ids), EMBEDDING_DIM), dtype=np.float32)
+        described = [i for i, x in enumerate(batch_ids) if x in descriptions]
+        if described:
+            vectors[described] = Models.encode_sentence(
+                [descriptions[batch_ids[i]] for i in described]
+            )
         with Models.get_embedding_db_conn() as con:
-            try:
-                con.execute(
-                    "INSERT INTO entity_embeddings (entity, embedding) VALUES (?, ?)",
-                    (entityId, emb.tobytes()),
-                )
-            except sqlite3.IntegrityError:
-                # happens when two workers are inserting embeddings
-                # of the same entity at the same time. can be safely ignored.
-                pass
-        logging.info("Entity embedding stored in db")
-    else:
-        emb = np.zeros(768)
-    return emb
+            # another worker may have stored the same entity in the meantime
+            con.executemany(
+                "INSERT OR IGNORE INTO entity_embeddings (entity, embedding) "
+                "VALUES (?, ?)",
+                [(x, vector.tobytes()) for x, vector in zip(batch_ids, vectors)],
+            )
+        embeddings.update(zip(batch_ids, vectors))
+    logging.info("Computed embeddings of %d entities", len(embeddings))
+    return embeddings
+
+
+@celery.task
+def backfill_entity_embeddings(entity_ids: List[str]):
+    compute_entity_embeddings(entity_ids)
+
+
+def queue_entity_embedding_backfill(entity_ids: List[str]):
+    entity_ids = [x for x in entity_ids if x not in _backfill_queued]
+    for entity_id in entity_ids:
+        _backfill_queued.put(entity_id, True)
+    if entity_ids:
+        logging.info("Queueing %d entity embeddings for backfill", len(entity_ids))
+        backfill_entity_embeddings.delay(entity_ids)
 
 
-def get_entity_embedding(entity_id: str) -> np.ndarray:
-    with Models.get_embedding_db_conn() as con:
-        emb = con.execute(
-            "select embedding from entity_embeddings where entity = ?", (entity_id,)
-        ).fetchone()
-    if emb is None:
-        emb = compute_entity_embedding(entity_id)
+def read_entity_embeddings(entity_ids: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Embeddings of `entity_ids` stored in SQLite.
+    """
+    embeddings = {}
+    con = Models.get_embedding_db_conn()
+    batch_size = 500  # below SQLite's limit of query parameters
+    for start in range(0, len(entity_ids), batch_size):
+        batch = entity_ids[start : start + batch_size]
+        rows = con.execute(
+            "select entity, embedding from entity_embeddings where entity in (%s)"
+            % ",".join("?" * len(batch)),
+            batch,
+        )
+        for entity_id, embedding in rows:
+            embeddings[entity_id] = np.frombuffer(embedding, dtype=np.float32)
+    return embeddings
+
+
+def get_entity_embeddings(
+    entity_ids: List[str], compute_missing: bool = False
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Embeddings of `entity_ids`, one row each. Rows are gathered from the
+    memory-mapped matrix, entities missing from it are read from SQLite.
+    Embeddings missing from both are computed if `compute_missing`, otherwise
+    they are queued for backfill and a zero embedding is used for now, so the
+    entity is only scored by name match.
+    Returns (embeddings, provisional), `provisional[i]` is True if the embedding
+    of `entity_ids[i]` is such a placeholder.
+    """
+    embeddings = {}
+    matrix = Models.get_entity_embedding_matrix()
+    if matrix is not None:
+        ids, vectors = matrix
+        query = np.array(entity_ids)
+        rows = np.minimum(np.searchsorted(ids, query), len(ids) - 1)
+        found = np.flatnonzero(ids[rows] == query)
+        found_vectors = np.asarray(vectors[rows[found]], dtype=np.float32)
+        embeddings.update(zip((entity_ids[i] for i in found), found_vectors))
+    missing = [x for x in entity_ids if x not in embeddings]
+    if missing:
+        embeddings.update(read_entity_embeddings(missing))
+        missing = [x for x in missing if x not in embeddings]
+    if missing:
+        if compute_missing:
+            embeddings.update(compute_entity_embeddings(missing))
+        else:
+            queue_entity_embedding_backfill(missing)
+    no_embedding = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    provisional = np.array([x not in embeddings for x in entity_ids])
+    return (
+        np.stack([embeddings.get(x, no_embedding) for x in entity_ids]),
+        provisional,
+    )
+
+
+def precompute_entity_embeddings(entity_type: str):
+    """
+    Compute the missing embeddings of all entities of `entity_type`, as in the
+    `types` field of the entity index.
+    """
+    query = {
+        "size": Config.entity_embedding_batch_size,
+        "query": {"term": {"types": entity_type.lower()}},
+        "fields": ["entity_id"],
+        "_source": False,
+    }
+    r = es_request(
+        "POST", f"/{Config.es_entity_collection}/_search?scroll=5m", json=query
+    ).json()
+    seen, computed = 0, 0
+    while r.get("hits", {}).get("hits"):
+        entity_ids = list({hit["fields"]["entity_id"][0] for hit in r["hits"]["hits"]})
+        stored = read_entity_embeddings(entity_ids)
+        missing = [x for x in entity_ids if x not in stored]
+        computed += len(compute_entity_embeddings(missing))
+        seen += len(entity_ids)
+        logging.info("%d entities, %d embeddings computed", seen, computed)
+        r = es_request(
+            "POST",
+            "/_search/scroll",
+            json={"scroll": "5m", "scroll_id": r["_scroll_id"]},
+        ).json()
+    if "_scroll_id" in r:
+        es_request("DELETE", "/_search/scroll", json={"scroll_id": r["_scroll_id"]})
+
+
+def build_entity_embedding_matrix(dtype=None):
+    """
+    Write all rows of `entity_embeddings` to the matrix read by
+    `get_entity_embeddings`, sorted by entity id.
+    """
+    dtype = np.dtype(dtype or Config.entity_embedding_dtype)
+    con = Models.get_embedding_db_conn()
+    count, max_id_length = con.execute(
+        "select count(*), max(length(entity)) from entity_embeddings"
+    ).fetchone()
+    if count == 0:
+        logging.warning("No entity embeddings in %s", Config.embeddings_db)
+        return
+    (first,) = con.execute("select embedding from entity_embeddings limit 1").fetchone()
+    dim = len(first) // np.dtype(np.float32).itemsize
+    logging.info("Building %d x %d %s entity embedding matrix", count, dim, dtype)
+
+    ids = np.empty(count, dtype=f"U{max_id_length}")
+    matrix_tmp = Config.entity_embedding_matrix + ".tmp"
+    matrix = np.lib.format.open_memmap(
+        matrix_tmp, mode="w+", dtype=dtype, shape=(count, dim)
+    )
+    rows = con.execute(
+        "select entity, embedding from entity_embeddings order by entity limit ?",
+        (count,),
+    )
+    for i, (entity_id, embedding) in enumerate(rows):
+        ids[i] = entity_id
+        matrix[i] = np.frombuffer(embedding, dtype=np.float32)
+    matrix.flush()
+    del matrix
+    # SQLite compares UTF-8 bytes, which is the same order as code points
+    assert np.all(ids[:-1] <= ids[1:]), "entity ids are not sorted"
+
+    ids_tmp = Config.entity_embedding_ids + ".tmp"
+    with open(ids_tmp, "wb") as f:
+        np.save(f, ids)
+    # workers still using the old files keep reading them until restarted
+    os.replace(matrix_tmp, Config.entity_embedding_matrix)
+    os.replace(ids_tmp, Config.entity_embedding_ids)
+    logging.info("Entity embedding matrix saved to %s", Config.entity_embedding_matrix)
+
+
+def _exact_search(
+    vectors: np.ndarray, queries: np.ndarray, k: int, chunk_size: int = 65536
+) -> np.ndarray:
+    """
+    Rows of the `k` largest inner products of each query, scanning `vectors` in
+    chunks to bound memory.
+    """
+    top_scores = np.empty((len(queries), 0), dtype=np.float32)
+    top_rows = np.empty((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start : start + chunk_size], dtype=np.float32)
+        scores = np.concatenate([top_scores, queries @ chunk.T], axis=1)
+        rows = np.concatenate(
+            [
+                top_rows,
+                np.broadcast_to(
+                    np.arange(start, start + len(chunk)), (len(queries), len(chunk))
+                ),
+            ],
+            axis=1,
+        )
+        kept = min(k, scores.shape[1])
+        best = np.argpartition(-scores, kept - 1, axis=1)[:, :kept]
+        top_scores = np.take_along_axis(scores, best, axis=1)
+        top_rows = np.take_along_axis(rows, best, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top_rows, order, axis=1)
+
+
+def search_entity_embeddings(
+    embeddings: np.ndarray, k: int, exact: bool = False
+) -> List[List[str]]:
+    """
+    Ids of the `k` entities whose embeddings have the largest inner product with
+    each row of `embeddings`. Uses the ANN index if it is built (and `exact` is
+    False), otherwise scans the whole embedding matrix.
+    """
+    matrix = Models.get_entity_embedding_matrix()
+    if matrix is None:
+        return [[] for _ in embeddings]
+    ids, vectors = matrix
+    queries = np.ascontiguousarray(embeddings, dtype=np.float32)
+    index = None if exact else Models.get_entity_ann_index()
+    if index is not None:
+        _, rows = index.search(queries, k)
     else:
-        emb = np.frombuffer(emb[0], dtype=np.float32)
-    return emb
+        rows = _exact_search(vectors, queries, k)
+    # faiss pads with -1 if fewer than k entities are found
+    return [[str(ids[row]) for row in query_rows if row >= 0] for query_rows in rows]
+
+
+def build_entity_ann_index():
+    """
+    Build the HNSW index (faiss) over the entity embedding matrix used by
+    `search_entity_embeddings`. Must be rebuilt with the matrix.
+    """
+    import faiss
+
+    matrix = Models.get_entity_embedding_matrix()
+    if matrix is None:
+        logging.warning("Build the entity embedding matrix first")
+        return
+    _, vectors = matrix
+    logging.info("Building HNSW index over %d entity embeddings", len(vectors))
+    index = faiss.IndexHNSWFlat(
+        vectors.shape[1], Config.entity_ann_hnsw_m, faiss.METRIC_INNER_PRODUCT
+    )
+    chunk_size = 65536
+    for start in range(0, len(vectors), chunk_size):
+        index.add(np.asarray(vectors[start : start + chunk_size], dtype=np.float32))
+    index_tmp = Config.entity_ann_index + ".tmp"
+    faiss.write_index(index, index_tmp)
+    os.replace(index_tmp, Config.entity_ann_index)
+    logging.info("Entity ANN index saved to %s", Config.entity_ann_index)
+
+
+def benchmark_lexical_candidates(num_queries=200):
+    """
+    Recall of the lexical candidates of `query_es_batch` and the latency of one
+    `_msearch` against a `query_es` call per name. Queries are the names of random
+    entities, a query is recalled if its entity is among the candidates.
+    """
+    num_queries = int(num_queries)
+    query = {
+        "size": num_queries,
+        "query": {"function_score": {"random_score": {"seed": 0, "field": "_seq_no"}}},
+        "fields": ["name", "entity_id", "types"],
+        "_source": False,
+    }
+    r = es_request("GET", f"/{Config.es_entity_collection}/_search", json=query).json()
+    samples = [
+        (
+            hit["fields"]["name"][0],
+            hit["fields"]["types"][0],
+            hit["fields"]["entity_id"][0],
+        )
+        for hit in r.get("hits", {}).get("hits", [])
+        if hit["fields"].get("name") and hit["fields"].get("types")
+    ]
+    if not samples:
+        logging.warning("No entities in %s", Config.es_entity_collection)
+        return
+    queries = [(name, mention_type) for name, mention_type, _ in samples]
+
+    start = time.perf_counter()
+    hits_list = query_es_batch(queries)
+    batch_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for name, mention_type in queries:
+        query_es(name, mention_type)
+    single_time = time.perf_counter() - start
+
+    recall = np.mean(
+        [
+            entity_id in {hit["fields"]["entity_id"][0] for hit in hits}
+            for (_, _, entity_id), hits in zip(samples, hits_list)
+        ]
+    )
+    logging.info(
+        "lexical recall: %.3f, %.1f candidates/query, _msearch: %.2f ms/query, "
+        "one request per query: %.2f ms/query",
+        recall,
+        np.mean([len(hits) for hits in hits_list]),
+        batch_time * 1000 / len(queries),
+        single_time * 1000 / len(queries),
+    )
+
+
+def benchmark_entity_ann(num_queries=200, k=10):
+    """
+    Recall@k of the ANN index against the exact scan and the latency of both.
+    Queries are perturbed embeddings of random entities.
+    The lexical candidates are benchmarked first, see `benchmark_lexical_candidates`.
+    """
+    # arguments are strings when called from the command line
+    num_queries, k = int(num_queries), int(k)
+    benchmark_lexical_candidates(num_queries)
+    matrix = Models.get_entity_embedding_matrix()
+    if matrix is None or Models.get_entity_ann_index() is None:
+        logging.warning("Build the entity embedding matrix and ANN index first")
+        return
+    _, vectors = matrix
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)
+    queries = np.asarray(vectors[np.sort(rows)], dtype=np.float32)
+    queries += rng.normal(scale=queries.std(), size=queries.shape).astype(np.float32)
+
+    start = time.perf_counter()
+    exact = search_entity_embeddings(queries, k, exact=True)
+    exact_time = time.perf_counter() - start
+    start = time.perf_counter()
+    approximate = search_entity_embeddings(queries, k)
+    approximate_time = time.perf_counter() - start
+
+    recall = np.mean(
+        [len(set(a) & set(e)) / len(e) for a, e in zip(approximate, exact)]
+    )
+    logging.info(
+        "recall@%d: %.3f, exact: %.2f ms/query, ANN: %.2f ms/query",
+        k,
+        recall,
+        exact_time * 1000 / len(queries),
+        approximate_time * 1000 / len(queries),
+    )
+    return recall, exact_time, approximate_time
 
 
-def rerank(hits: List[Dict], embedding: np.ndarray) -> List[Dict]:
+def rerank(
+    hits_list: List[List[Dict]], embeddings: np.ndarray, compute_missing: bool = False
+) -> List[List[Dict]]:
+    """
+    Rerank the hits of many mentions, `embeddings[i]` is the context embedding of
+    the mention of `hits_list[i]`.
+    `compute_missing`: see `get_entity_embeddings`, hits scored with a placeholder
+    embedding are marked with `_provisional`.
+    """
     sentence_emb_weight = 1.0
     score_weight = 3.0
 
-    for hit in hits:
-        hit_emb = get_entity_embedding(hit["fields"]["entity_id"][0])
+    all_hits = [hit for hits in hits_list for hit in hits]
+    if len(all_hits) == 0:
+        return hits_list
+    owners = np.array([i for i, hits in enumerate(hits_list) for _ in hits])
+    entity_rows = {}
+    for hit in all_hits:
+        entity_rows.setdefault(hit["fields"]["entity_id"][0], len(entity_rows))
+    entity_embeddings, provisional = get_entity_embeddings(
+        list(entity_rows.keys()), compute_missing=compute_missing
+    )
+    hit_rows = [entity_rows[hit["fields"]["entity_id"][0]] for hit in all_hits]
+    similarities = np.einsum(
+        "ij,ij->i", embeddings[owners], entity_embeddings[hit_rows]
+    )
+    for hit, similarity, placeholder in zip(
+        all_hits, np.maximum(similarities, 0), provisional[hit_rows]
+    ):
         hit["_score"] = (
-            max(np.dot(embedding, hit_emb), 0) * sentence_emb_weight
-            + hit["_score"] * score_weight
+            float(similarity) * sentence_emb_weight + hit["_score"] * score_weight
         )
-    hits.sort(key=lambda x: x["_score"], reverse=True)
-    return hits
+        hit["_provisional"] = bool(placeholder)
+    for hits in hits_list:
+        hits.sort(key=lambda x: x["_score"], reverse=True)
+    return hits_list
 
 
 def follow_coreference(paragraph, mention):
@@ -141,44 +577,121 @@ def follow_coreference(paragraph, mention):
     return mention
 
 
-@celery.task
-def run_linker(paragraph, mention) -> Optional[str]:
-    logging.info("run linker")
+def mention_context(paragraph, sent_idx: int, context_window: int = 1) -> str:
     """
-    returns entity id
+    The sentence of a mention, plus its neighbours if the context is short.
     """
-    mention = follow_coreference(paragraph, mention)
-    mention = EntityMention(**mention)
-
     max_length = 384
-    context_window = 1
-    context = sentence_to_string(paragraph[mention.sent_idx])[:max_length]
+    context = sentence_to_string(paragraph[sent_idx])[:max_length]
     for i in range(1, 1 + context_window):
         if len(context) > max_length:
             break
-        if mention.sent_idx - i >= 0:
-            new_context = sentence_to_string(paragraph[mention.sent_idx - i])
+        if sent_idx - i >= 0:
+            new_context = sentence_to_string(paragraph[sent_idx - i])
             if len(new_context) + len(context) < 500:
                 context = new_context + " " + context
-        if mention.sent_idx + i < len(paragraph):
-            new_context = sentence_to_string(paragraph[mention.sent_idx + i])
+        if sent_idx + i < len(paragraph):
+            new_context = sentence_to_string(paragraph[sent_idx + i])
             if len(new_context) + len(context) < 500:
                 context = context + " " + new_context
+    return context
+
 
-    context_embedding = Models.encode_sentence(context)
-    hits = query_es(mention.text, mention.type)
-    hits = rerank(hits, context_embedding)
-    candidates = [
-        Candidate(
-            hit["fields"]["entity_id"][0], hit["_score"], hit["fields"]["aliases"]
+def encode_contexts(
+    paragraph, sent_indices: List[int], context_window: int = 1
+) -> np.ndarray:
+    """
+    Context embedding (see `mention_context`) of each sentence in `sent_indices`.
+    Each (sentence, window) is encoded at most once per call, and the embeddings
+    of recently seen context strings are reused.
+    """
+    context_keys = {}  # (sent_idx, window) -> hash of the context string
+    to_encode = {}  # hash -> context string
+    embeddings = {}  # hash -> embedding
+    for sent_idx in set(sent_indices):
+        context = mention_context(paragraph, sent_idx, context_window)
+        key = content_hash(context)
+        context_keys[(sent_idx, context_window)] = key
+        if key in embeddings or key in to_encode:
+            continue
+        embedding = _context_embedding_cache.get(key)
+        if embedding is None:
+            to_encode[key] = context
+        else:
+            embeddings[key] = embedding
+    if to_encode:
+        vectors = Models.encode_sentence(list(to_encode.values()))
+        for key, vector in zip(to_encode.keys(), vectors):
+            _context_embedding_cache.put(key, vector)
+            embeddings[key] = vector
+    return np.stack(
+        [embeddings[context_keys[(i, context_window)]] for i in sent_indices]
+    )
+
+
+@celery.task
+def run_linker(paragraph, mention) -> List[Candidate]:
+    """
+    Candidate entities of `mention`, sorted by score
+    """
+    logging.info("run linker")
+    return run_linker_batch(paragraph, [mention])[0]
+
+
+@celery.task
+def run_linker_batch(
+    paragraph, mentions, compute_missing=False
+) -> List[List[Candidate]]:
+    """
+    `run_linker` for many mentions of the same paragraph, with one encoder batch,
+    one `_msearch` and one reranking pass.
+    `compute_missing`: compute missing entity embeddings before reranking
+    instead of backfilling them in the background.
+    """
+    logging.info("run linker on %d mentions", len(mentions))
+    if len(mentions) == 0:
+        return []
+    mentions = [
+        EntityMention(**follow_coreference(paragraph, mention)) for mention in mentions
+    ]
+    context_embeddings = encode_contexts(
+        paragraph, [mention.sent_idx for mention in mentions]
+    )
+    dense_candidates = None
+    if Config.linker_dense_candidates > 0:
+        dense_candidates = search_entity_embeddings(
+            context_embeddings, Config.linker_dense_candidates
         )
-        for hit in hits
+    hits_list = query_es_batch(
+        [(mention.text, mention.type) for mention in mentions], dense_candidates
+    )
+    hits_list = rerank(hits_list, context_embeddings, compute_missing)
+    return [
+        [
+            Candidate(
+                hit["fields"]["entity_id"][0],
+                hit["_score"],
+                hit["fields"]["aliases"],
+                hit["_provisional"],
+            )
+            for hit in hits
+        ]
+        for hits in hits_list
     ]
 
-    return candidates
 
+commands = {
+    "build-embedding-matrix": build_entity_embedding_matrix,
+    "build-ann-index": build_entity_ann_index,
+    "benchmark-ann": benchmark_entity_ann,
+    "precompute-embeddings": precompute_entity_embeddings,
+}
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        logging.basicConfig(level=logging.INFO)
+        commands[sys.argv[1]](*sys.argv[2:])
+        sys.exit(0)
     celery.start(
         argv=[
             "-A",
@@ -1,11 +1,17 @@
-import json
 import logging
-from tempfile import NamedTemporaryFile
 from dataclasses import dataclass
 from typing import *
 
 from .rpc import create_celery
-from .utils import Models, asdict, dynamic_import
+from .utils import (
+    Models,
+    MicroBatcher,
+    LRUCache,
+    SQLiteCache,
+    asdict,
+    content_hash,
+    dynamic_import,
+)
 from .config import Config
 
 
@@ -83,17 +89,38 @@ Sentence = List[Token]
 Paragraph = List[Sentence]
 
 
-def extract_sentences(title: str, content: str) -> Tuple[List[str], List[str]]:
+def _split_paragraphs(title: str, content: str) -> List[str]:
     paragraphs = [title]
     paragraphs.extend(content.split("\n\n"))
     paragraphs = [x for x in paragraphs if not x.startswith("-- ")]  # drop metadata
     paragraphs = [x for x in paragraphs if x.strip()]
     paragraphs = [x.replace("\n", " ") for x in paragraphs]  # drop superfluous newlines
-
-    processed = []
-    pos = []
-    for paragraph in paragraphs:
-        doc = Models.nlp(paragraph)
+    return paragraphs
+
+
+def extract_sentences_batch(
+    documents: List[Tuple[str, str]], n_process=None, batch_size=None
+) -> List[Tuple[List[List[str]], List[List[str]]]]:
+    """
+    Split many documents, given as (title, content), into tokenized sentences
+    with one `nlp.pipe` pass over all their paragraphs.
+    Returns (sentences, pos) of each document.
+    """
+    if n_process is None:
+        n_process = Config.spacy_n_process
+    if batch_size is None:
+        batch_size = Config.spacy_batch_size
+
+    paragraphs = []
+    for doc_idx, (title, content) in enumerate(documents):
+        paragraphs.extend((x, doc_idx) for x in _split_paragraphs(title, content))
+
+    outputs = [([], []) for _ in documents]
+    docs = Models.sentence_pipeline().pipe(
+        paragraphs, as_tuples=True, n_process=n_process, batch_size=batch_size
+    )
+    for doc, doc_idx in docs:
+        processed, pos = outputs[doc_idx]
         for sent in doc.sents:
             tokens = [x.text for x in sent if x.text.strip()]
             token_pos = [x.pos_ for x in sent if x.text.strip()]
@@ -101,7 +128,11 @@ def extract_sentences(title: str, content: str) -> Tuple[List[str], List[str]]:
                 processed.append(tokens)
                 pos.append(token_pos)
 
-    return processed, pos
+    return outputs
+
+
+def extract_sentences(title: str, content: str) -> Tuple[List[str], List[str]]:
+    return extract_sentences_batch([(title, content)])[0]
 
 
 def parse_raw_ner_output(sentences, token_pos, ner_output):
@@ -146,36 +177,84 @@ def parse_raw_ner_output(sentences, token_pos, ner_output):
     return paragraph
 
 
-@celery.task
-def run_ner(sentences) -> Paragraph:
-    external_run_ner = dynamic_import(Config.ner_script, Config.ner_script_entrypoint)
-
-    with NamedTemporaryFile("w") as pure_input_file, NamedTemporaryFile(
-        "r"
-    ) as pure_output_file:
-        json.dump({"sentences": sentences, "doc_key": "placeholder"}, pure_input_file)
-        pure_input_file.flush()
-
-        # run pure
+def get_ner_engine():
+    """
+    The PURE entity model stays resident in the worker,
+    `run_ner.py` is only imported once.
+    """
+    engine = Models.get_preloaded_model("ner_engine")
+    if engine is None:
+        create_engine = dynamic_import(
+            Config.ner_script, Config.ner_engine_entrypoint
+        )
         cmd_args = [
             "--model",
             "bert-base-uncased",
             "--model_dir",
             Config.ner_model,
-            "--output_dir",
-            "/tmp",
             "--context_window",
             "300",
-            "--test_data",
-            pure_input_file.name,
-            "--test_pred_filename",
-            pure_output_file.name,
         ]
-        external_run_ner(cmd_args, Models)
+        if Config.ner_prune_spans:
+            cmd_args.append("--prune_spans")
+        engine = create_engine(cmd_args, Models)
+        Models.save_preloaded_model("ner_engine", engine)
+    return engine
+
+
+# sentence-level NER outputs, shared by documents repeating the same sentences
+if Config.ner_sentence_cache_db:
+    _sentence_cache = SQLiteCache(
+        Config.ner_sentence_cache_db,
+        "ner_sentences",
+        maxsize=Config.ner_sentence_cache_size,
+    )
+else:
+    _sentence_cache = LRUCache(maxsize=Config.ner_sentence_cache_size)
+
+
+def _sentence_cache_key(sample) -> str:
+    # the prediction depends on the context of the sentence, not only on itself
+    return content_hash(
+        sample["tokens"],
+        sample["sent_start"],
+        sample["sent_end"],
+        Config.ner_model,
+        Config.ner_prune_spans,
+        Config.CacheKeys.raw_pure_ner_output,
+    )
+
+
+def _predict_documents(documents):
+    engine = get_ner_engine()
+    samples = engine.build_samples(documents)
+    keys = [_sentence_cache_key(sample) for sample in samples]
+    sample_spans = [_sentence_cache.get(key) for key in keys]
+    misses = [i for i, spans in enumerate(sample_spans) if spans is None]
+    logging.info(
+        "NER sentence cache: %d hits, %d misses",
+        len(samples) - len(misses),
+        len(misses),
+    )
+    predictions = engine.predict_samples([samples[i] for i in misses])
+    for i, spans in zip(misses, predictions):
+        sample_spans[i] = spans
+    _sentence_cache.put_many((keys[i], sample_spans[i]) for i in misses)
+    return engine.collect_document_predictions(documents, samples, sample_spans)
 
-        # read output
-        ner_output = json.load(pure_output_file)["predicted_ner"]
-        return ner_output
+
+# documents from concurrent run_ner tasks share the same model batches
+_ner_batcher = MicroBatcher(
+    _predict_documents,
+    window=Config.ner_batch_window,
+    max_size=Config.ner_batch_max_tokens,
+    size_of=lambda sentences: sum(len(sent) for sent in sentences),
+)
+
+
+@celery.task
+def run_ner(sentences) -> Paragraph:
+    return _ner_batcher.submit(sentences)
 
 
 def is_subseq(a, b):
@@ -234,11 +313,11 @@ if __name__ == "__main__":
             "worker",
             "-l",
             "INFO",
-            "--concurrency=1",
+            f"--concurrency={Config.ner_worker_concurrency}",
             "-Q",
             "ner",
             "-P",
-            "solo",
+            "threads",
             "-n",
             "ner-worker@%n",
         ]
@@ -1,48 +1,52 @@
 """
 AMR parsing for semantic analysis
 """
-from tempfile import TemporaryDirectory
 import os
 import re
-import json
+import sys
+import time
 from itertools import product
 from dataclasses import dataclass
 from typing import *
+from collections import Counter, defaultdict
 import logging
-from pathlib import Path
 
-try:
-    from lark import Lark, Tree, Transformer, LarkError
-except ImportError as e:
-    import os
-
-    if os.environ.get("RPC_CALLER") is None:
-        raise e
-
-    class Transformer:
-        # mock class
-        pass
-
-
-from .utils import asdict, dynamic_import, Models as model_manager
+from .utils import (
+    dynamic_import,
+    content_hash,
+    log_sampled,
+    LRUCache,
+    StageTimer,
+    Models as model_manager,
+)
 from .config import Config
 from .ner import extract_sentences
 from .rpc import create_celery
 
-
-with open(Path(__file__).parent / "penman.ebnf") as f:
-    _grammar = f.read()
-_parser = None
+logger = logging.getLogger(__name__)
+logger.setLevel(Config.amr_log_level)
+# decode / repair / parse time of this process
+amr_timer = StageTimer("AMR")
 
 amr_parsing_celery = create_celery("workbench.semantic", "amr_parsing")
 amr2text_celery = create_celery("workbench.semantic", "amr2text")
 
 
-@dataclass
 class AMRVariable:
-    name: str
-    concept: str
-    _edges: List["AMREdge"]
+    """
+    Outbound edges are indexed by relation. `id` is the index in `AMRGraph.nodes`.
+    """
+
+    __slots__ = ("id", "name", "concept", "_out", "_outbound")
+
+    def __init__(self, name: str, concept: str, edges: List["AMREdge"] = None):
+        self.id: int = None
+        self.name = name
+        self.concept = concept
+        self._out: Dict[str, List["AMREdge"]] = {}
+        self._outbound: List["AMREdge"] = None  # sorted by relation, lazily built
+        for edge in edges or []:
+            self._add(edge)
 
     def asdict(self):
         return {"name": self.name, "concept": self.concept}
@@ -54,10 +58,10 @@ class AMRVariable:
         return str(self)
 
     def __getitem__(self, rel) -> "AMRNode":
-        for edge in self._edges:
-            if edge.var1 == self and edge.relationship == rel:
-                return edge.var2
-        raise KeyError
+        edges = self._out.get(rel)
+        if not edges:
+            raise KeyError(rel)
+        return edges[0].var2
 
     def pretty_tree(self, indent=0) -> str:
         r = ""
@@ -68,18 +72,44 @@ class AMRVariable:
         return r
 
     def get(self, rel, fallback=None) -> Optional["AMRNode"]:
-        try:
-            return self[rel]
-        except KeyError:
-            return fallback
+        edges = self._out.get(rel)
+        return edges[0].var2 if edges else fallback
+
+    def edges_of(self, rel) -> List["AMREdge"]:
+        return self._out.get(rel, [])
+
+    def iter_edges(self) -> Iterator["AMREdge"]:
+        """
+        Outbound edges, grouped by relation in order of first appearance.
+        """
+        for edges in self._out.values():
+            yield from edges
+
+    @property
+    def relations(self) -> Iterable[str]:
+        return self._out.keys()
 
     @property
     def outbound_edges(self) -> List["AMREdge"]:
-        edges = [edge for edge in self._edges if edge.var1 == self]
-        return sorted(edges, key=lambda edge: edge.relationship)
+        if self._outbound is None:
+            self._outbound = [
+                edge for rel in sorted(self._out) for edge in self._out[rel]
+            ]
+        return self._outbound
+
+    def _add(self, edge: "AMREdge"):
+        self._out.setdefault(edge.relationship, []).append(edge)
+        self._outbound = None
+
+    def _remove(self, edge: "AMREdge"):
+        edges = self._out[edge.relationship]
+        edges.remove(edge)
+        if not edges:
+            del self._out[edge.relationship]
+        self._outbound = None
 
     def add_edge(self, var2, relationship):
-        self._edges.append(AMREdge(self, var2, relationship))
+        self._add(AMREdge(self, var2, relationship))
 
     def to_spring(self, delim="\u0120", lit_begin="<lit>", lit_end="</lit>") -> str:
         s = f"{delim}( {delim}<pointer:{self.name[1:]}> {delim}{self.concept} "
@@ -89,14 +119,19 @@ class AMRVariable:
         return s
 
 
-@dataclass
 class AMRConstant:
-    value: Union[int, str, float]
-    name: str = None
-    literal: bool = False
+    __slots__ = ("id", "value", "name", "literal")
+
+    def __init__(
+        self, value: Union[int, str, float], name: str = None, literal: bool = False
+    ):
+        self.id: int = None
+        self.value = value
+        self.name = name
+        self.literal = literal
 
     def asdict(self):
-        return asdict(self)
+        return {"value": self.value, "name": self.name, "literal": self.literal}
 
     def __str__(self):
         return str(self.value)
@@ -116,6 +151,7 @@ class AMRConstant:
 
 @dataclass
 class AMRRef:
+    # only exists between parsing and `amr_tree_to_graph`
     name: str
 
     def to_spring(self, delim="\u0120", lit_begin=None, lit_end=None) -> str:
@@ -125,11 +161,13 @@ class AMRRef:
 AMRNode = Union[AMRVariable, AMRConstant, AMRRef]
 
 
-@dataclass
 class AMREdge:
-    var1: AMRNode
-    var2: AMRNode
-    relationship: str
+    __slots__ = ("var1", "var2", "relationship")
+
+    def __init__(self, var1: AMRNode, var2: AMRNode, relationship: str):
+        self.var1 = var1
+        self.var2 = var2
+        self.relationship = relationship
 
     def asdict(self):
         return {
@@ -145,10 +183,20 @@ class AMREdge:
         return str(self)
 
 
-@dataclass
 class AMRGraph:
-    nodes: List[AMRVariable]
-    edges: List[AMREdge]
+    __slots__ = ("nodes", "edges")
+
+    def __init__(self, nodes: List[AMRNode], edges: List[AMREdge]):
+        self.nodes = nodes
+        self.edges = edges
+        self.assign_ids()
+
+    def assign_ids(self):
+        for i, node in enumerate(self.nodes):
+            node.id = i
+
+    def variables(self) -> Iterator[AMRVariable]:
+        return (x for x in self.nodes if type(x) == AMRVariable)
 
     def asdict(self):
         return {
@@ -157,88 +205,193 @@ class AMRGraph:
         }
 
 
+class AMRSyntaxError(ValueError):
+    pass
+
+
+_penman_token = re.compile(r'\s*("(?:[^"\\]|\\.)*"|[()/:]|[^\s()/:"]+|\S)')
+_penman_var_name = re.compile(r"[a-z]\d+")
+_penman_concept = re.compile(r"[\w\-]+")
+_penman_relation = re.compile(r"[\w\-\@]+")
+_penman_symbol = re.compile(
+    r"[+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?|[+-]|[\w\-]+"
+)
+
+
+class PenmanReader:
+    """
+    Recursive-descent reader for the PENMAN notation described in `penman.ebnf`.
+    AMRVariable / AMRConstant / AMRRef nodes are built while parsing.
+    """
+
+    def __init__(self, text: str):
+        self.tokens = _penman_token.findall(text)
+        self.pos = 0
+
+    def parse(self) -> AMRNode:
+        node = self._tree()
+        if self.pos != len(self.tokens):
+            raise AMRSyntaxError(f"unexpected token {self.tokens[self.pos]!r}")
+        return node
+
+    def _peek(self) -> Optional[str]:
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def _next(self, pattern=None, expected=None) -> str:
+        if self.pos >= len(self.tokens):
+            raise AMRSyntaxError("unexpected end of input")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        if pattern is not None and not pattern.fullmatch(token):
+            raise AMRSyntaxError(f"expected {expected}, got {token!r}")
+        return token
+
+    def _expect(self, expected: str):
+        token = self._next()
+        if token != expected:
+            raise AMRSyntaxError(f"expected {expected!r}, got {token!r}")
+
+    def _tree(self) -> AMRNode:
+        token = self._next()
+        if token == "(":
+            name = self._next(_penman_var_name, "variable name")
+            self._expect("/")
+            concept = self._next(_penman_concept, "concept")
+            node = AMRVariable(name, concept)
+            while self._peek() == ":":
+                self.pos += 1
+                relation = self._next(_penman_relation, "relation")
+                node.add_edge(self._tree(), relation)
+            self._expect(")")
+            return node
+        elif _penman_var_name.fullmatch(token):
+            return AMRRef(token)
+        else:
+            return self._literal(token)
+
+    @staticmethod
+    def _literal(token: str) -> AMRConstant:
+        if len(token) >= 2 and token[0] == '"' and token[-1] == '"':
+            return AMRConstant(token[1:-1], None, True)
+        if not _penman_symbol.fullmatch(token):
+            raise AMRSyntaxError(f"invalid constant {token!r}")
+        if token in ("+", "-", "imperative", "expressive"):
+            return AMRConstant(token)
+        for transforms in (int, float):
+            try:
+                return AMRConstant(transforms(token))
+            except ValueError:
+                pass
+        return AMRConstant(token)
+
+
+def parse_penman(text: str) -> AMRNode:
+    """
+    Parse one AMR in PENMAN notation, raises AMRSyntaxError if it is malformed.
+    """
+    return PenmanReader(text).parse()
+
+
+def get_amr_generator(task):
+    """
+    The AMRBART generator of `task` ("text2amr" or "amr2text") stays resident in
+    the worker.
+    """
+    generator = model_manager.get_preloaded_model(f"{task}_generator")
+    if generator is None:
+        if task == "text2amr":
+            AMRBartGenerator = dynamic_import(
+                Config.amr_script, Config.amr_script_entrypoint
+            )
+            generator = AMRBartGenerator(task, Config.amr_model, 300, model_manager)
+        else:
+            AMRBartGenerator = dynamic_import(
+                Config.amr2text_script, Config.amr2text_script_entrypoint
+            )
+            generator = AMRBartGenerator(
+                task, Config.amr2text_model, 768, model_manager
+            )
+        model_manager.save_preloaded_model(f"{task}_generator", generator)
+    return generator
+
+
+# sentence-level AMRBART outputs, shared by all documents containing the sentence
+_amr_sentence_cache = LRUCache(maxsize=Config.amr_sentence_cache_size)
+
+
+def _amr_sentence_cache_key(sent: str) -> str:
+    normalized = " ".join(sent.split())
+    return content_hash(normalized, Config.amr_model, Config.CacheKeys.amr_output)
+
+
+def _parse_sentences(sentences: List[str]) -> List[str]:
+    """
+    AMRBART output of each sentence. Only sentences not in the cache are decoded.
+    """
+    keys = [_amr_sentence_cache_key(sent) for sent in sentences]
+    outputs = [_amr_sentence_cache.get(key) for key in keys]
+    to_decode = {}  # key -> sentence, identical sentences are decoded once
+    for sent, key, amr in zip(sentences, keys, outputs):
+        if amr is None:
+            to_decode[key] = sent
+    logger.info(
+        "AMR sentence cache: %d hits, %d sentences to decode",
+        sum(amr is not None for amr in outputs),
+        len(to_decode),
+    )
+    if to_decode:
+        with amr_timer("decode", len(to_decode)):
+            decoded = get_amr_generator("text2amr").generate(
+                list(to_decode.values()),
+                batch_size=Config.amr_max_batch_size,
+                max_tokens=Config.amr_max_batch_tokens,
+                num_beams=5,
+                beam_schedule=Config.amr_beam_schedule,
+                max_length=768,
+                length_cap=Config.amr_length_cap,
+            )
+        for key, amr in zip(to_decode.keys(), decoded):
+            _amr_sentence_cache.put(key, amr)
+            to_decode[key] = amr
+        outputs = [
+            to_decode[key] if amr is None else amr for key, amr in zip(keys, outputs)
+        ]
+    return outputs
+
+
 @amr_parsing_celery.task
-def run_amr_parsing(title, content, return_amrbart_format=False) -> str:
-    import torch
-    logging.info("Run amr parsing...")
-    sentences, _ = extract_sentences(title, content)
+def run_amr_parsing(
+    title, content, return_amrbart_format=False, sentences=None
+) -> str:
+    """
+    `sentences`: tokenized sentences of the document, if they are already known.
+    """
+    logger.info("Run amr parsing...")
+    timings = amr_timer.snapshot()
+    if sentences is None:
+        sentences, _ = extract_sentences(title, content)
     sentences = [" ".join(sent) for sent in sentences]
     if len(sentences) == 0:
         return ""
-    with TemporaryDirectory() as amr_input_dir, TemporaryDirectory() as amr_output_dir:
-        logging.info("amr ourput dir: %s", amr_output_dir)
-        with open(f"{amr_input_dir}/test.jsonl", "w") as amr_input_file:
-            for sent in sentences:
-                amr_input_file.write(json.dumps({"sent": sent, "amr": ""}) + "\n")
-
-        env = os.environ
-        env["OMP_NUM_THREADS"] = "16"
-        # run amrbart
-        cmd_args = {
-            "data_dir": amr_input_dir,
-            "task": "text2amr",
-            "test_file": amr_input_dir + "/test.jsonl",
-            "output_dir": amr_output_dir,
-            "data_cache_dir": "/tmp",
-            "overwrite_cache": True,
-            "model_name_or_path": Config.amr_model,
-            "overwrite_output_dir": "",
-            "unified_input": True,
-            "per_device_eval_batch_size": 4,
-            "max_source_length": 300,
-            "max_target_length": 768,
-            "val_max_target_length": 768,
-            "generation_max_length": 768,
-            "generation_num_beams": 5,
-            "predict_with_generate": "",
-            "smart_init": False,
-            "use_fast_tokenizer": False,
-            "logging_dir": "/tmp",
-            "seed": 42,
-            "dataloader_num_workers": 4,
-            "eval_dataloader_num_workers": 4,
-            "do_predict": "",
-            "include_inputs_for_metrics": "",
-            "ddp_find_unused_parameters": False,
-            "report_to": "tensorboard",
-            "dataloader_pin_memory": True,
-        }
-
-        if torch.cuda.is_available():  # use fp16 if gpu is available
-            cmd_args["fp16"] = ""
-            cmd_args["fp16_backend"] = "auto"
-            cmd_args["fp16_full_eval"] = ""
-
-        cmd_args_array = []
-        for k, v in cmd_args.items():
-            cmd_args_array.append(f"--{k}")
-            if v != "":
-                cmd_args_array.append(str(v))
-        print(cmd_args_array)
-        call_amrbart = dynamic_import(Config.amr_script, Config.amr_script_entrypoint)
-        call_amrbart(cmd_args_array, model_manager)
-
-        with open(f"{amr_output_dir}/generated_predictions.txt") as f:
-            raw_output = f.readlines()
-        assert len(raw_output) == len(sentences)
-
-        if not return_amrbart_format:
-            output_lines = []
-            for sent, amr in zip(sentences, raw_output):
-                sent = sent.replace("\n", " ")
-                amr = amr.replace("</AMR>", "")
-                amr = convert_amrbart_v2_output(amr)
-                output_lines.append(f"# ::snt {sent}")
-                output_lines.append(amr)
-                output_lines.append("")
-            return "\n".join(output_lines)
-        else:
-            amrbart_output = []
-            for sent, amr in zip(sentences, raw_output):
-                sent = sent.replace("\n", " ")
-                amr = amr.replace("</AMR>", "")
-                amrbart_output.append({"sent": sent, "amr": amr})
-            return amrbart_output
+    sentences = [sent.replace("\n", " ") for sent in sentences]
+    raw_output = _parse_sentences(sentences)
+    assert len(raw_output) == len(sentences)
+
+    if not return_amrbart_format:
+        output_lines = []
+        for sent, amr in zip(sentences, convert_amrbart_v2_outputs(raw_output)):
+            output_lines.append(f"# ::snt {sent}")
+            output_lines.append(amr)
+            output_lines.append("")
+        amr_timer.log(logger, since=timings)
+        return "\n".join(output_lines)
+    else:
+        amrbart_output = []
+        for sent, amr in zip(sentences, raw_output):
+            amrbart_output.append({"sent": sent, "amr": amr})
+        return amrbart_output
 
 
 @amr2text_celery.task
@@ -247,80 +400,22 @@ def run_amr_to_text(roots: List[AMRNode], amrbart_input: List = None) -> List[st
     Each amr graph must be a rooted tree.
     Pass in the root nodes.
     """
-    import torch
     if amrbart_input is None:
         amrbart_input = []
     if len(roots) + len(amrbart_input) == 0:
         return []
-    with TemporaryDirectory() as amr_input_dir, TemporaryDirectory() as amr_output_dir:
-        with open(f"{amr_input_dir}/test.jsonl", "w") as amr_input_file:
-            for root in roots:
-                amr_string = root.to_spring(delim=" ", lit_begin='"', lit_end='"')
-                amr_input_file.write(json.dumps({"sent": "", "amr": amr_string}))
-                amr_input_file.write("\n")
-            for amr in amrbart_input:
-                amr_input_file.write(json.dumps(amr))
-                amr_input_file.write("\n")
-
-        env = os.environ
-        env["OMP_NUM_THREADS"] = "8"
-        # run amrbart
-        cmd_args = {
-            "data_dir": amr_input_dir,
-            "task": "amr2text",
-            "test_file": amr_input_dir + "/test.jsonl",
-            "output_dir": amr_output_dir,
-            "data_cache_dir": "/tmp",
-            "overwrite_cache": True,
-            "overwrite_output_dir": "",
-            "model_name_or_path": Config.amr2text_model,
-            "unified_input": True,
-            "per_device_eval_batch_size": 4,
-            "max_source_length": 768,
-            "max_target_length": 300,
-            "val_max_target_length": 300,
-            "generation_max_length": 300,
-            "generation_num_beams": 5,
-            "predict_with_generate": "",
-            "smart_init": False,
-            "use_fast_tokenizer": False,
-            "logging_dir": "/tmp",
-            "seed": 42,
-            "dataloader_num_workers": 4,
-            "eval_dataloader_num_workers": 2,
-            "do_predict": "",
-            "include_inputs_for_metrics": "",
-            "ddp_find_unused_parameters": False,
-            "report_to": "tensorboard",
-            "dataloader_pin_memory": True,
-        }
-        if torch.cuda.is_available():  # use fp16 if gpu is available
-            cmd_args["fp16"] = ""
-            cmd_args["fp16_backend"] = "auto"
-            cmd_args["fp16_full_eval"] = ""
-
-        cmd_args_array = []
-        for k, v in cmd_args.items():
-            cmd_args_array.append(f"--{k}")
-            if v != "":
-                cmd_args_array.append(str(v))
-        print(cmd_args_array)
-        call_amrbart = dynamic_import(
-            Config.amr2text_script, Config.amr2text_script_entrypoint
-        )
-        call_amrbart(cmd_args_array, model_manager)
-
-        with open(f"{amr_output_dir}/generated_predictions.txt") as f:
-            return f.readlines()
+    amr_strings = [
+        root.to_spring(delim=" ", lit_begin='"', lit_end='"') for root in roots
+    ]
+    amr_strings.extend(amr["amr"] for amr in amrbart_input)
+    return get_amr_generator("amr2text").generate(
+        amr_strings, batch_size=4, num_beams=5, max_length=300
+    )
 
 
 def parse_amr_output_file_content(
     content, should_simplify_graph=False, **kwargs
 ) -> List[Tuple[str, AMRGraph]]:
-    global _parser
-    if _parser is None:
-        _parser = Lark(_grammar, start="amr_tree")
-
     lines = content.split("\n")
     lines.append("")
     outputs = []
@@ -335,17 +430,35 @@ def parse_amr_output_file_content(
         elif not line.strip():
             if len(amr_output_lines) > 0:
                 amr_output = " ".join(amr_output_lines)
+                amr_output_lines = []
                 try:
-                    tree = _parser.parse(amr_output)
-                except LarkError:
-                    logging.warning(f"Failed to parse AMR: {amr_output}")
+                    with amr_timer("parse"):
+                        tree = parse_penman(amr_output)
+                        graph = amr_tree_to_graph(tree, **kwargs)
+                except AMRSyntaxError as e:
+                    logger.warning("Failed to parse AMR (%s): %s", e, amr_output)
                     continue
-                graph = amr_tree_to_graph(tree, **kwargs)
                 outputs.append((sent, graph))
-                print(sent)
-                amr_output_lines = []
+                log_sampled(logger, Config.amr_debug_sample_rate, "Parsed: %s", sent)
         else:
             amr_output_lines.append(line)
+    amr_timer.log(logger, logging.DEBUG)
+    return outputs
+
+
+# parsed graphs of AMR outputs that are parsed repeatedly (person relations,
+# resumed /semantic streams), callers must not modify them
+_amr_graph_cache = LRUCache(maxsize=Config.amr_graph_cache_size)
+
+
+def parse_amr_output_file_content_cached(
+    content, **kwargs
+) -> List[Tuple[str, AMRGraph]]:
+    key = content_hash(content, sorted(kwargs.items()))
+    outputs = _amr_graph_cache.get(key)
+    if outputs is None:
+        outputs = parse_amr_output_file_content(content, **kwargs)
+        _amr_graph_cache.put(key, outputs)
     return outputs
 
 
@@ -354,96 +467,92 @@ def parse_amr_output_file(filename, **kwargs):
         return parse_amr_output_file_content(f.read(), **kwargs)
 
 
-def convert_amrbart_v2_output(v2_output):
-    output = v2_output
-    # try to fix mismatched brackets
-    if output.count("(") != output.count(")"):
-        tokens = []
-        for line in output.splitlines():
-            tokens.extend(line.strip().split())
-            tokens.append('\n')
-        tokens.pop()
-        open_paren = 0
-        tracking = True
-        for i, token in enumerate(tokens):
-            if token == '\n':
-                continue
-            print(f"tok {token}", open_paren, tracking)
-            if token == '<lit>':
-                tracking = False
-            elif token == '</lit>':
-                tracking = True
-            if not tracking:
-                continue
-            if token == '(':
-                open_paren += 1
-            elif token == ')':
-                if open_paren == 0:
-                    tokens[i] = ''
-                else:
-                    open_paren -= 1
-        output = " ".join(tokens)
-    # convert <pointer:N> to zN
-    output = re.sub(r"<pointer:(\d+)>", r"z\1 /", output, flags=re.MULTILINE)
-    # convert zN / ) to zN) (if zN is a reference and is the last argument)
-    output = re.sub(r"z(\d+) / \)", r"z\1 )", output, flags=re.MULTILINE)
-    # convert zN / : to zN : (if zN is a reference and is not the last argument)
-    output = re.sub(r"z(\d+) / :", r"z\1 :", output, flags=re.MULTILINE)
-    # convert <lit> and </lit> to "
-    output = re.sub(r"<lit> ", r'"', output, flags=re.MULTILINE)
-    output = re.sub(r" </lit>", r'"', output, flags=re.MULTILINE)
+def _is_reference_end(tokens: List[str], i: int) -> bool:
+    return i >= len(tokens) or tokens[i] == ")" or tokens[i].startswith(":")
 
+
+def convert_amrbart_v2_output(v2_output: str) -> str:
+    """
+    Convert one AMRBART output to PENMAN in a single scan over its tokens:
+    `<pointer:N>` becomes `zN /` (or the reference `zN` before `)` and relations),
+    `<lit> ... </lit>` becomes a quoted string, unmatched `)` are dropped,
+    unclosed `(` are closed at the end, and anything after `</AMR>` is ignored.
+    """
+    tokens = v2_output.partition("</AMR>")[0].split()
+    output = []
+    depth = 0
+    literal = None  # tokens of the current <lit>, if any
+    repaired = False
+    for i, token in enumerate(tokens):
+        if literal is not None:
+            if token == "</lit>":
+                output.append('"' + " ".join(literal) + '"')
+                literal = None
+            else:
+                literal.append(token)
+        elif token == "(":
+            depth += 1
+            output.append(token)
+        elif token == ")":
+            if depth == 0:
+                repaired = True
+                continue
+            depth -= 1
+            output.append(token)
+        elif token == "<lit>":
+            literal = []
+        elif token.startswith("<pointer:") and token.endswith(">"):
+            output.append("z" + token[9:-1])
+            if not _is_reference_end(tokens, i + 1):
+                output.append("/")
+        elif token == "/" and _is_reference_end(tokens, i + 1):
+            continue  # `zN / )`, a reference written as a variable
+        else:
+            output.append(token)
+    if literal is not None:
+        output.append('"' + " ".join(literal) + '"')
+        repaired = True
+    if depth > 0:
+        output.append(" ".join(")" * depth))
+        repaired = True
+    output = " ".join(output)
+    if repaired:
+        log_sampled(
+            logger, Config.amr_debug_sample_rate, "Repaired brackets: %s", output
+        )
     return output
 
 
-class ParseToAMRTreeTransformer(Transformer):
-    def attr(self, children):
-        relation = children[0].value
-        var2 = children[1]
-        edge = AMREdge(None, var2, relation)
-        return edge
-
-    def arg(self, children):
-        return self.attr(children)
-
-    def literal(self, value):
-        assert len(value) > 0
-        value = value[0].value
-        is_literal = False
-        if value[0] == '"':
-            value = value[1:-1]
-            is_literal = True
-        elif value in ("+", "-", "imperative", "expressive"):
-            pass
-        else:
-            for transforms in (int, float):
-                try:
-                    value = transforms(value)
-                    break
-                except ValueError:
-                    pass
-        return AMRConstant(value, None, is_literal)
-
-    def var_ref(self, children):
-        return AMRRef(children[0].value)
-
-    def var_def(self, children):
-        name = children[0].value
-        concept = children[1].value
-        edges = children[2:]
-        node = AMRVariable(name, concept, edges)
-        for e in node._edges:
-            e.var1 = node
-        return node
+def convert_amrbart_v2_outputs(v2_outputs: List[str]) -> List[str]:
+    """
+    Convert the AMRBART outputs of a whole document to PENMAN.
+    """
+    with amr_timer("repair", len(v2_outputs)):
+        return [convert_amrbart_v2_output(output) for output in v2_outputs]
 
 
-def amr_tree_to_graph(tree: "Tree", add_inv_edges_to_nodes=False) -> AMRGraph:
+def benchmark_amrbart_conversion(filename, repeat=1000):
+    """
+    Throughput of convert_amrbart_v2_outputs on a file with one AMRBART output per
+    line, e.g. tests/sample-amr-v2.txt.
     """
-    Convert AMR tree to graph
+    # arguments are strings when called from the command line
+    repeat = int(repeat)
+    with open(filename, "r") as f:
+        v2_outputs = [line for line in f.read().splitlines() if line.strip()]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        convert_amrbart_v2_outputs(v2_outputs)
+    elapsed = time.perf_counter() - start
+    logging.info("converted %.0f AMRs/s", repeat * len(v2_outputs) / elapsed)
+
+
+def amr_tree_to_graph(amr_tree: AMRNode, add_inv_edges_to_nodes=False) -> AMRGraph:
+    """
+    Convert AMR tree (see `parse_penman`) to graph
     1. resolve variable references
     2. invert edges if relation ends with "-of"
     """
-    amr_tree = ParseToAMRTreeTransformer().transform(tree)
     nodes = []
     node_map = {}
     edges = []
@@ -459,18 +568,21 @@ def amr_tree_to_graph(tree: "Tree", add_inv_edges_to_nodes=False) -> AMRGraph:
         if isinstance(node, AMRVariable):
             nodes.append(node)
             node_map[node.name] = node
-            for e in node._edges:
+            for e in node.iter_edges():
                 collect_nodes(e.var2)
 
     def collect_edges(node: AMRNode):
         if isinstance(node, AMRVariable):
-            for e in node._edges:
+            for e in list(node.iter_edges()):
                 collect_edges(e.var2)
                 if isinstance(e.var2, AMRRef):  # resolve reference
+                    if e.var2.name not in node_map:
+                        raise AMRSyntaxError(f"undefined variable {e.var2.name}")
                     e.var2 = node_map[e.var2.name]
                 if (
                     e.relationship.endswith("-of") and e.relationship != "consist-of"
                 ):  # inverse relationship
+                    node._remove(e)
                     e.relationship = e.relationship[:-3]
                     e.var1, e.var2 = e.var2, e.var1
                     if add_inv_edges_to_nodes:
@@ -480,133 +592,262 @@ def amr_tree_to_graph(tree: "Tree", add_inv_edges_to_nodes=False) -> AMRGraph:
     collect_nodes(amr_tree)
     collect_edges(amr_tree)
     for e in inv_edges:  # if add_inv_edges_to_nodes
-        for e in inv_edges:
-            e.var1._edges.append(e)
+        e.var1._add(e)
     return AMRGraph(nodes, edges)
 
 
 def simplify_graph(graph: AMRGraph):
-    new_name_nodes = {}
+    new_name_nodes = {}  # id of name node -> merged name constant
     nodes_to_remove = set()
     edges = []
     for edge in graph.edges:
         if edge.relationship == "wiki":
-            nodes_to_remove.add(edge.var2.name)
+            nodes_to_remove.add(edge.var2.id)
             # remove wiki edges
             continue
-        elif edge.var1.name in new_name_nodes:
+        elif edge.var1.id in new_name_nodes:
             # already
             continue
         elif isinstance(edge.var1, AMRVariable) and edge.var1.concept == "name":
             name_node = edge.var1
             # combine names
             parts = []
-            i = 1  # this part is O(n^2) but I assume n is small enough
+            i = 1
             while True:
-                try:
-                    op_edge = next(
-                        x for x in edge.var1._edges if x.relationship == f"op{i}"
-                    )
-                    parts.append(str(op_edge.var2.value))
-                    nodes_to_remove.add(op_edge.var2.name)
-                    i += 1
-                except StopIteration:
+                op = name_node.get(f"op{i}")
+                if op is None:
                     break
+                parts.append(str(op.value))
+                nodes_to_remove.add(op.id)
+                i += 1
             new_node = AMRConstant(" ".join(parts), "c" + name_node.name)
-            new_name_nodes[name_node.name] = new_node
+            new_name_nodes[name_node.id] = new_node
         else:
             edges.append(edge)
     for edge in edges:
-        if edge.var2.name in new_name_nodes:
-            edge.var2 = new_name_nodes[edge.var2.name]
+        if edge.var2.id in new_name_nodes:
+            edge.var2 = new_name_nodes[edge.var2.id]
     graph.edges = edges
     graph.nodes = [
         x
         for x in graph.nodes
-        if x.name not in new_name_nodes and x.name not in nodes_to_remove
+        if x.id not in new_name_nodes and x.id not in nodes_to_remove
     ] + list(new_name_nodes.values())
+    graph.assign_ids()
     return graph
 
 
-def extract_person_relations(graph: AMRGraph) -> List[AMRVariable]:
-    person_nodes = [
-        x for x in graph.nodes if type(x) == AMRVariable and x.concept == "person"
-    ]
-    person_nodes = [x for x in person_nodes if x.get("name") is not None]
-    relations: List[AMRVariable] = []
+_predicate_concept = re.compile(r".*-\d\d")
+_pointer = re.compile(r"<pointer:(\d+)>")
+
 
-    def clone_subtree(root: AMRNode, is_top: bool = False) -> List[AMRNode]:
+def canonical_spring(root: AMRNode) -> str:
+    """
+    SPRING linearization of a (sub)graph with pointers renumbered by first
+    appearance, so identical subgraphs get the same string wherever they occur.
+    """
+    spring = root.to_spring(delim=" ", lit_begin='"', lit_end='"')
+    numbers = {}
+
+    def renumber(match):
+        return f"<pointer:{numbers.setdefault(match.group(1), len(numbers))}>"
+
+    return _pointer.sub(renumber, spring)
+
+
+def _unique(nodes: Iterable[AMRNode], limit: int, stats: Counter) -> List[AMRNode]:
+    """
+    Up to `limit` nodes from `nodes` with distinct canonical forms. `stats` counts
+    the dropped duplicates and the nodes left out by the limit.
+    """
+    seen = set()
+    outputs = []
+    nodes = iter(nodes)
+    for node in nodes:
+        key = canonical_spring(node)
+        if key in seen:
+            stats["duplicates"] += 1
+            continue
+        if len(outputs) >= limit:
+            # the rest are only counted, not canonicalized
+            stats["capped"] += 1 + sum(1 for _ in nodes)
+            break
+        seen.add(key)
+        outputs.append(node)
+    return outputs
+
+
+def extract_person_relations(
+    graph: AMRGraph, max_relations: int = None, stats: Counter = None
+) -> List[AMRVariable]:
+    """
+    Subgraphs of `graph` relating named persons to predicates.
+    Alternatives, like the operands of `and`, are expanded lazily. Subgraphs with
+    the same canonical form are kept once, up to `max_relations` subgraphs.
+    `stats` counts the candidates that were pruned.
+    """
+    if max_relations is None:
+        max_relations = Config.person_relation_max_subgraphs
+    if stats is None:
+        stats = Counter()
+    max_alternatives = Config.person_relation_max_alternatives
+    person_ids = {
+        x.id
+        for x in graph.variables()
+        if x.concept == "person" and x.get("name") is not None
+    }
+    parents = defaultdict(list)  # id -> parent nodes
+    for edge in graph.edges:
+        parents[edge.var2.id].append(edge.var1)
+
+    def clone_subtree(
+        root: AMRNode, is_top: bool = False, path: FrozenSet[int] = frozenset()
+    ) -> Iterator[AMRNode]:
         if type(root) == AMRConstant:
-            return [AMRConstant(root.value, root.name)]
+            yield AMRConstant(root.value, root.name)
+            return
         root: AMRVariable
+        path = path | {root.id}  # skip cycles through reentrancies
         if root.concept == "and":
             if is_top:
                 # find its parent
-                parents = [x.var1 for x in graph.edges if x.var2 == root]
-                return [
-                    node for x in parents for node in clone_subtree(x, is_root=True)
-                ]
+                for x in parents[root.id]:
+                    if x.id not in path:
+                        yield from clone_subtree(x, True, path)
             else:
                 # bypass and
-                return [
-                    node
-                    for x in root.outbound_edges
-                    if x.relationship.startswith("op")
-                    for node in clone_subtree(x.var2)
-                ]
-
-        is_entity = re.match(r".*-\d\d", root.concept) is not None
+                for x in root.outbound_edges:
+                    if x.relationship.startswith("op") and x.var2.id not in path:
+                        yield from clone_subtree(x.var2, False, path)
+            return
+
+        is_entity = _predicate_concept.match(root.concept) is not None
         attributes_to_keep = ("name", "location", "time", "polarity", "topic")
-        new_root = AMRVariable(root.name, root.concept, [])
         new_edge_rels = []
         new_edge_alts = []
         for edge in root.outbound_edges:
+            if edge.var2.id in path:
+                continue
             keep_edge = is_entity and edge.relationship in attributes_to_keep
             keep_edge |= root.concept in ("name", "date-entity")
             keep_edge |= edge.relationship in attributes_to_keep
             keep_edge |= is_top and edge.relationship.startswith("ARG")
             if keep_edge:
-                new_leaves = clone_subtree(edge.var2, is_top=False)
+                new_leaves = _unique(
+                    clone_subtree(edge.var2, False, path), max_alternatives, stats
+                )
                 new_edge_rels.append(edge.relationship)
                 new_edge_alts.append(new_leaves)
-        new_roots = []
         for leaves in product(*new_edge_alts):
-            new_root = AMRVariable(root.name, root.concept, [])
+            new_root = AMRVariable(root.name, root.concept)
             for edge_rel, leaf in zip(new_edge_rels, leaves):
                 assert type(leaf) == AMRVariable or type(leaf) == AMRConstant, leaf
                 new_root.add_edge(leaf, edge_rel)
-            new_roots.append(new_root)
+            yield new_root
 
-        return new_roots
+    def candidates() -> Iterator[AMRVariable]:
+        for var in graph.variables():
+            if any(
+                edge.var2.id in person_ids
+                for rel in var.relations
+                if rel.startswith("ARG")
+                for edge in var.edges_of(rel)
+            ):
+                yield from clone_subtree(var, is_top=True)
 
-    for var in (x for x in graph.nodes if type(x) == AMRVariable):
-        if any(
-            x.var2 in person_nodes and x.relationship.startswith("ARG")
-            for x in var.outbound_edges
-        ):
-            rels = clone_subtree(var, is_top=True)
-            relations.extend(rels)
-    return relations
+    return _unique(candidates(), max_relations, stats)
 
 
-def extract_person_relations_from_amr_content(amr_content):
-    sents_and_graphs = parse_amr_output_file_content(
+# AMR2Text outputs of recently seen subgraphs, keyed by canonical linearization
+_amr2text_cache = LRUCache(maxsize=Config.amr2text_cache_size)
+
+
+def lookup_amr_to_text(roots: List[AMRNode]):
+    """
+    Look up the AMR2Text outputs of `roots` in the cache.
+    Returns (keys, texts, to_generate), where texts are None for cache misses and
+    `to_generate` maps the key of each distinct miss to its subgraph.
+    """
+    keys = [
+        content_hash(canonical_spring(root), Config.amr2text_model) for root in roots
+    ]
+    texts = [_amr2text_cache.get(key) for key in keys]
+    to_generate = {}  # key -> root, identical subgraphs are generated once
+    for root, key, text in zip(roots, keys, texts):
+        if text is None:
+            to_generate[key] = root
+    logger.info(
+        "AMR2Text cache: %d/%d hits, %d subgraphs to generate",
+        sum(text is not None for text in texts),
+        len(texts),
+        len(to_generate),
+    )
+    return keys, texts, to_generate
+
+
+def store_amr_to_text(keys, texts, generated_keys, generated) -> List[str]:
+    """
+    Cache the `generated` texts of `generated_keys` and fill in the misses of
+    `texts` (see `lookup_amr_to_text`).
+    """
+    generated = dict(zip(generated_keys, generated))
+    for key, text in generated.items():
+        _amr2text_cache.put(key, text)
+    return [generated[key] if text is None else text for key, text in zip(keys, texts)]
+
+
+def amr_to_text_cached(roots: List[AMRNode]) -> List[str]:
+    """
+    `run_amr_to_text`, where only subgraphs missing from the cache are sent to the
+    AMR2Text worker.
+    """
+    keys, texts, to_generate = lookup_amr_to_text(roots)
+    generated = []
+    if to_generate:
+        generated = run_amr_to_text.delay(list(to_generate.values())).get()
+    return store_amr_to_text(keys, texts, list(to_generate.keys()), generated)
+
+
+def extract_person_relation_graphs(amr_content) -> Tuple[List[str], List[AMRNode]]:
+    """
+    Person relation subgraphs of all sentences, and the sentence of each subgraph.
+    """
+    sents_and_graphs = parse_amr_output_file_content_cached(
         amr_content, add_inv_edges_to_nodes=True
     )
     sents = []
     rel_graphs = []
+    stats = Counter()
     for sent, graph in sents_and_graphs:
-        relations = extract_person_relations(graph)
+        relations = extract_person_relations(graph, stats=stats)
         for rel in relations:
             sents.append(sent)
             rel_graphs.append(rel)
-    texts = run_amr_to_text.delay(rel_graphs).get()
+    logger.info(
+        "Person relations: %d subgraphs, %d duplicates dropped, %d over the cap",
+        len(rel_graphs),
+        stats["duplicates"],
+        stats["capped"],
+    )
+    return sents, rel_graphs
+
+
+def extract_person_relations_from_amr_content(amr_content):
+    sents, rel_graphs = extract_person_relation_graphs(amr_content)
+    texts = amr_to_text_cached(rel_graphs)
     return list(zip(sents, texts, rel_graphs))
 
 
+commands = {
+    "benchmark-conversion": benchmark_amrbart_conversion,
+}
+
 if __name__ == "__main__":
-    import logging
-    import os
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        logging.basicConfig(level=logging.INFO)
+        commands[sys.argv[1]](*sys.argv[2:])
+        sys.exit(0)
+
     import torch
 
     if torch.cuda.is_available():
@@ -0,0 +1,244 @@
+# coding=utf-8
+"""
+In-process AMRBART inference, without the trainer, datasets or temporary files.
+"""
+
+import logging
+
+import torch
+from transformers import AutoConfig
+from model_interface.modeling_bart import BartForConditionalGeneration
+from model_interface.tokenization_bart import AMRBartTokenizer
+
+logger = logging.getLogger(__name__)
+
+
+def load_model(task, model_name_or_path, model_manager=None):
+    """
+    Load `(config, tokenizer, model)` the same way as `main.py`, sharing the
+    preloaded instance with it through `model_manager`.
+    """
+    if model_manager is not None:
+        preloaded_model = model_manager.get_preloaded_model(task)
+        if preloaded_model is not None:
+            return preloaded_model
+    config = AutoConfig.from_pretrained(model_name_or_path)
+    tokenizer = AMRBartTokenizer.from_pretrained(model_name_or_path, use_fast=False)
+    model = BartForConditionalGeneration.from_pretrained(
+        model_name_or_path, config=config
+    )
+    model.resize_token_embeddings(len(tokenizer))
+    if model_manager is not None:
+        model_manager.save_preloaded_model(task, (config, tokenizer, model))
+    return config, tokenizer, model
+
+
+class AMRBartGenerator:
+    """
+    Resident AMRBART model for `text2amr` (sentences -> linearized AMR) or
+    `amr2text` (linearized AMR -> sentences).
+    Inputs are tokenized in memory and passed to `model.generate` directly.
+    """
+
+    def __init__(
+        self, task, model_name_or_path, max_source_length, model_manager=None
+    ):
+        assert task in ("amr2text", "text2amr"), f"Invalid task name: {task}"
+        self.task = task
+        self.config, self.tokenizer, self.model = load_model(
+            task, model_name_or_path, model_manager
+        )
+        self.max_source_length = min(
+            max_source_length, self.tokenizer.model_max_length
+        )
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model.to(self.device)
+        if self.device.type == "cuda":  # use fp16 if gpu is available
+            self.model.half()
+        self.model.eval()
+
+        if task == "text2amr":
+            self.decoder_start_token_id = self.tokenizer.amr_bos_token_id
+            self.decoder_end_token_id = self.tokenizer.amr_eos_token_id
+        else:
+            self.decoder_start_token_id = self.tokenizer.eos_token_id
+            self.decoder_end_token_id = self.tokenizer.eos_token_id
+
+    def encode(self, inputs):
+        """
+        Input ids of each sentence (`text2amr`) or linearized AMR (`amr2text`),
+        identical to the `unified_input` format of the datasets used in training.
+        """
+        tokenizer = self.tokenizer
+        if self.task == "text2amr":
+            raw_ids = tokenizer(
+                inputs,
+                max_length=self.max_source_length,
+                padding=False,
+                truncation=True,
+            )["input_ids"]
+            return [
+                ids[: self.max_source_length - 3]
+                + [
+                    tokenizer.amr_bos_token_id,
+                    tokenizer.mask_token_id,
+                    tokenizer.amr_eos_token_id,
+                ]
+                for ids in raw_ids
+            ]
+        else:
+            # [<s>[mask]</s><AMR>xxx</AMR>]
+            return [
+                [
+                    tokenizer.bos_token_id,
+                    tokenizer.mask_token_id,
+                    tokenizer.eos_token_id,
+                    tokenizer.amr_bos_token_id,
+                ]
+                + tokenizer.tokenize_amr(amr.split())[: self.max_source_length - 5]
+                + [tokenizer.amr_eos_token_id]
+                for amr in inputs
+            ]
+
+    def _pad(self, batch_ids):
+        max_len = max(len(ids) for ids in batch_ids)
+        input_ids = torch.full(
+            (len(batch_ids), max_len), self.tokenizer.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((len(batch_ids), max_len), dtype=torch.long)
+        for i, ids in enumerate(batch_ids):
+            input_ids[i, : len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, : len(ids)] = 1
+        return input_ids.to(self.device), attention_mask.to(self.device)
+
+    @torch.no_grad()
+    def generate_ids(self, batch_ids, num_beams=5, max_length=768, length_penalty=1.0):
+        """
+        Decode one batch of encoded inputs, returns the generated strings.
+        """
+        input_ids, attention_mask = self._pad(batch_ids)
+        generated_tokens = self.model.generate(
+            input_ids,
+            attention_mask=attention_mask,
+            num_beams=num_beams,
+            use_cache=True,
+            decoder_start_token_id=self.decoder_start_token_id,
+            eos_token_id=self.decoder_end_token_id,
+            no_repeat_ngram_size=0,
+            max_length=max_length,
+            min_length=0,
+            length_penalty=length_penalty,
+        )
+        decoded = self.tokenizer.batch_decode(
+            generated_tokens,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False,
+        )
+        if self.task == "text2amr":
+            # </AMR> is not a special token, drop it and anything after it
+            amr_eos_token = self.tokenizer.amr_eos_token
+            decoded = [text.partition(amr_eos_token)[0] for text in decoded]
+        return decoded
+
+    def schedule(
+        self,
+        all_ids,
+        batch_size=4,
+        max_tokens=None,
+        num_beams=5,
+        beam_schedule=None,
+        max_length=768,
+        length_cap=None,
+    ):
+        """
+        Group encoded inputs of similar lengths into batches.
+        `batch_size`: max number of inputs per batch
+        `max_tokens`: max padded source tokens * beams per batch
+        `beam_schedule`: [(source length, beams)] sorted by source length, inputs
+            longer than all thresholds use `num_beams`
+        `length_cap`: (a, k), the max target length of a batch is
+            min(max_length, a + k * source length)
+        Returns a list of (indices, num_beams, max_length).
+        """
+
+        def beams_of(length):
+            for threshold, beams in beam_schedule or []:
+                if length <= threshold:
+                    return beams
+            return num_beams
+
+        order = sorted(range(len(all_ids)), key=lambda i: len(all_ids[i]))
+        buckets = []
+        batch, batch_beams = [], None
+        for i in order:
+            # inputs are sorted, so the current one is the longest of the batch
+            length = len(all_ids[i])
+            beams = beams_of(length)
+            if batch and (
+                beams != batch_beams
+                or len(batch) >= batch_size
+                or (
+                    max_tokens is not None
+                    and length * beams * (len(batch) + 1) > max_tokens
+                )
+            ):
+                buckets.append((batch, batch_beams))
+                batch = []
+            batch.append(i)
+            batch_beams = beams
+        if batch:
+            buckets.append((batch, batch_beams))
+
+        batches = []
+        for batch, beams in buckets:
+            batch_max_length = max_length
+            if length_cap is not None:
+                a, k = length_cap
+                src_length = len(all_ids[batch[-1]])
+                batch_max_length = min(max_length, int(a + k * src_length))
+            batches.append((batch, beams, batch_max_length))
+        return batches
+
+    def generate(
+        self,
+        inputs,
+        batch_size=4,
+        num_beams=5,
+        max_length=768,
+        length_penalty=1.0,
+        max_tokens=None,
+        beam_schedule=None,
+        length_cap=None,
+    ):
+        """
+        `inputs`: sentences (`text2amr`) or linearized AMR graphs (`amr2text`).
+        Inputs are decoded in length-sorted batches, see `schedule`.
+        Returns one generated string per input, in the original order.
+        """
+        all_ids = self.encode(inputs)
+        batches = self.schedule(
+            all_ids,
+            batch_size=batch_size,
+            max_tokens=max_tokens,
+            num_beams=num_beams,
+            beam_schedule=beam_schedule,
+            max_length=max_length,
+            length_cap=length_cap,
+        )
+        outputs = [None] * len(inputs)
+        for batch, batch_beams, batch_max_length in batches:
+            decoded = self.generate_ids(
+                [all_ids[i] for i in batch],
+                num_beams=batch_beams,
+                max_length=batch_max_length,
+                length_penalty=length_penalty,
+            )
+            for i, output in zip(batch, decoded):
+                outputs[i] = output
+        logger.info(
+            "Generated %d outputs for %s in %d batches",
+            len(outputs),
+            self.task,
+            len(batches),
+        )
+        return outputs
@@ -9,7 +9,7 @@ from allennlp.modules import FeedForward
 
 import numpy as np
 
-from transformers import BertTokenizer, BertPreTrainedModel, BertModel
+from transformers import BertTokenizerFast, BertPreTrainedModel, BertModel
 from transformers import AlbertTokenizer, AlbertPreTrainedModel, AlbertModel
 
 import os
@@ -226,6 +226,7 @@ class AlbertForEntity(AlbertPreTrainedModel):
 class EntityModel:
     def __init__(self, args, num_ner_labels):
         super().__init__()
+        self.num_ner_labels = num_ner_labels
 
         bert_model_name = args.model
         vocab_name = bert_model_name
@@ -244,7 +245,7 @@ class EntityModel:
                 max_span_length=args.max_span_length,
             )
         else:
-            self.tokenizer = BertTokenizer.from_pretrained(vocab_name)
+            self.tokenizer = BertTokenizerFast.from_pretrained(vocab_name)
             self.bert_model = BertForEntity.from_pretrained(
                 bert_model_name,
                 num_ner_labels=num_ner_labels,
@@ -265,7 +266,11 @@ class EntityModel:
         if torch.cuda.device_count() > 1:
             self.bert_model = torch.nn.DataParallel(self.bert_model)
 
-    def _get_input_tensors(self, tokens, spans, spans_ner_label):
+    def _get_word_pieces(self, tokens):
+        """
+        Tokenize words one by one (used when the tokenizer is not a fast tokenizer)
+        Returns word piece ids, and the first / last word piece index of each word.
+        """
         start2idx = []
         end2idx = []
 
@@ -278,125 +283,118 @@ class EntityModel:
             end2idx.append(len(bert_tokens) - 1)
         bert_tokens.append(self.tokenizer.sep_token)
 
-        assert len(bert_tokens) <= 512
-
         indexed_tokens = self.tokenizer.convert_tokens_to_ids(bert_tokens)
-        tokens_tensor = torch.tensor([indexed_tokens])
-
-        bert_spans = [[start2idx[span[0]], end2idx[span[1]], span[2]] for span in spans]
-        bert_spans_tensor = torch.tensor([bert_spans])
-
-        spans_ner_label_tensor = torch.tensor([spans_ner_label])
-
-        return tokens_tensor, bert_spans_tensor, spans_ner_label_tensor
-
-    def _get_input_tensors_batch(self, samples_list, training=True):
-        tokens_tensor_list = []
-        bert_spans_tensor_list = []
-        spans_ner_label_tensor_list = []
-        sentence_length = []
-
-        max_tokens = 0
-        max_spans = 0
-        for sample in samples_list:
-            tokens = sample["tokens"]
-            spans = sample["spans"]
-            spans_ner_label = sample["spans_label"]
-
-            try:
-                (
-                    tokens_tensor,
-                    bert_spans_tensor,
-                    spans_ner_label_tensor,
-                ) = self._get_input_tensors(tokens, spans, spans_ner_label)
-            except AssertionError:
+        return indexed_tokens, start2idx, end2idx
+
+    def _get_word_pieces_batch(self, samples_list):
+        """
+        Tokenize the words of all samples with one fast tokenizer call.
+        """
+        if not self.tokenizer.is_fast:
+            return [self._get_word_pieces(sample["tokens"]) for sample in samples_list]
+
+        encodings = self.tokenizer(
+            [sample["tokens"] for sample in samples_list], is_split_into_words=True
+        )
+        word_pieces = []
+        for b, sample in enumerate(samples_list):
+            indexed_tokens = encodings["input_ids"][b]
+            num_words = len(sample["tokens"])
+            start2idx = [-1] * num_words
+            end2idx = [-1] * num_words
+            for idx, word_idx in enumerate(encodings.word_ids(b)):
+                if word_idx is None:
+                    continue
+                if start2idx[word_idx] < 0:
+                    start2idx[word_idx] = idx
+                end2idx[word_idx] = idx
+            # a word without word pieces starts at the next word piece and ends
+            # at the previous one, same as in `_get_word_pieces`
+            next_idx = len(indexed_tokens) - 1
+            for word_idx in reversed(range(num_words)):
+                if start2idx[word_idx] < 0:
+                    start2idx[word_idx] = next_idx
+                    end2idx[word_idx] = next_idx - 1
+                else:
+                    next_idx = start2idx[word_idx]
+            word_pieces.append((indexed_tokens, start2idx, end2idx))
+        return word_pieces
+
+    def _get_input_tensors_batch(
+        self, samples_list, training=True, return_kept=False
+    ):
+        """
+        Samples longer than 512 word pieces are left out of the tensors.
+        `return_kept`: also return the indices (in `samples_list`) of the samples
+        in the tensors, all tensors are None if no sample is kept.
+        """
+        kept = []
+        kept_samples = []
+        kept_word_pieces = []
+        for i, (sample, word_pieces) in enumerate(
+            zip(samples_list, self._get_word_pieces_batch(samples_list))
+        ):
+            if len(word_pieces[0]) > 512:
+                logger.warning(
+                    "Sample %s-%s is longer than 512 word pieces, skipped",
+                    sample.get("doc_key"),
+                    sample.get("sentence_ix"),
+                )
                 continue
-            tokens_tensor_list.append(tokens_tensor)
-            bert_spans_tensor_list.append(bert_spans_tensor)
-            spans_ner_label_tensor_list.append(spans_ner_label_tensor)
-            assert bert_spans_tensor.shape[1] == spans_ner_label_tensor.shape[1]
-            if tokens_tensor.shape[1] > max_tokens:
-                max_tokens = tokens_tensor.shape[1]
-            if bert_spans_tensor.shape[1] > max_spans:
-                max_spans = bert_spans_tensor.shape[1]
-            sentence_length.append(sample["sent_length"])
-
-        if len(tokens_tensor_list) == 0:
+            kept.append(i)
+            kept_samples.append(sample)
+            kept_word_pieces.append(word_pieces)
+
+        if len(kept_samples) == 0:
+            if return_kept:
+                return (None,) * 6 + (kept,)
             raise AssertionError("all samples are filtered out")
 
-        sentence_length = torch.Tensor(sentence_length)
+        sentence_length = torch.Tensor(
+            [sample["sent_length"] for sample in kept_samples]
+        )
 
-        # apply padding and concatenate tensors
-        final_tokens_tensor = None
-        final_attention_mask = None
-        final_bert_spans_tensor = None
-        final_spans_ner_label_tensor = None
-        final_spans_mask_tensor = None
-        for tokens_tensor, bert_spans_tensor, spans_ner_label_tensor in zip(
-            tokens_tensor_list, bert_spans_tensor_list, spans_ner_label_tensor_list
+        # allocate padded tensors once and fill them in place
+        batch_size = len(kept_samples)
+        max_tokens = max(len(x[0]) for x in kept_word_pieces)
+        max_spans = max(len(sample["spans"]) for sample in kept_samples)
+        final_tokens_tensor = torch.full(
+            [batch_size, max_tokens], self.tokenizer.pad_token_id, dtype=torch.long
+        )
+        final_attention_mask = torch.zeros([batch_size, max_tokens], dtype=torch.long)
+        final_bert_spans_tensor = torch.zeros(
+            [batch_size, max_spans, 3], dtype=torch.long
+        )
+        final_spans_mask_tensor = torch.zeros(
+            [batch_size, max_spans], dtype=torch.long
+        )
+        final_spans_ner_label_tensor = torch.zeros(
+            [batch_size, max_spans], dtype=torch.long
+        )
+        for b, (sample, (indexed_tokens, start2idx, end2idx)) in enumerate(
+            zip(kept_samples, kept_word_pieces)
         ):
-            # padding for tokens
-            num_tokens = tokens_tensor.shape[1]
-            tokens_pad_length = max_tokens - num_tokens
-            attention_tensor = torch.full([1, num_tokens], 1, dtype=torch.long)
-            if tokens_pad_length > 0:
-                pad = torch.full(
-                    [1, tokens_pad_length],
-                    self.tokenizer.pad_token_id,
-                    dtype=torch.long,
-                )
-                tokens_tensor = torch.cat((tokens_tensor, pad), dim=1)
-                attention_pad = torch.full([1, tokens_pad_length], 0, dtype=torch.long)
-                attention_tensor = torch.cat((attention_tensor, attention_pad), dim=1)
-
-            # padding for spans
-            num_spans = bert_spans_tensor.shape[1]
-            spans_pad_length = max_spans - num_spans
-            spans_mask_tensor = torch.full([1, num_spans], 1, dtype=torch.long)
-            if spans_pad_length > 0:
-                pad = torch.full(
-                    [1, spans_pad_length, bert_spans_tensor.shape[2]],
-                    0,
-                    dtype=torch.long,
-                )
-                bert_spans_tensor = torch.cat((bert_spans_tensor, pad), dim=1)
-                mask_pad = torch.full([1, spans_pad_length], 0, dtype=torch.long)
-                spans_mask_tensor = torch.cat((spans_mask_tensor, mask_pad), dim=1)
-                spans_ner_label_tensor = torch.cat(
-                    (spans_ner_label_tensor, mask_pad), dim=1
+            num_tokens = len(indexed_tokens)
+            final_tokens_tensor[b, :num_tokens] = torch.tensor(indexed_tokens)
+            final_attention_mask[b, :num_tokens] = 1
+
+            spans = torch.tensor(sample["spans"], dtype=torch.long).view(-1, 3)
+            num_spans = spans.shape[0]
+            final_bert_spans_tensor[b, :num_spans, 0] = torch.tensor(start2idx)[
+                spans[:, 0]
+            ]
+            final_bert_spans_tensor[b, :num_spans, 1] = torch.tensor(end2idx)[
+                spans[:, 1]
+            ]
+            final_bert_spans_tensor[b, :num_spans, 2] = spans[:, 2]
+            final_spans_mask_tensor[b, :num_spans] = 1
+            if "spans_label" in sample:
+                assert len(sample["spans_label"]) == num_spans
+                final_spans_ner_label_tensor[b, :num_spans] = torch.tensor(
+                    sample["spans_label"], dtype=torch.long
                 )
 
-            # update final outputs
-            if final_tokens_tensor is None:
-                final_tokens_tensor = tokens_tensor
-                final_attention_mask = attention_tensor
-                final_bert_spans_tensor = bert_spans_tensor
-                final_spans_ner_label_tensor = spans_ner_label_tensor
-                final_spans_mask_tensor = spans_mask_tensor
-            else:
-                final_tokens_tensor = torch.cat(
-                    (final_tokens_tensor, tokens_tensor), dim=0
-                )
-                final_attention_mask = torch.cat(
-                    (final_attention_mask, attention_tensor), dim=0
-                )
-                final_bert_spans_tensor = torch.cat(
-                    (final_bert_spans_tensor, bert_spans_tensor), dim=0
-                )
-                final_spans_ner_label_tensor = torch.cat(
-                    (final_spans_ner_label_tensor, spans_ner_label_tensor), dim=0
-                )
-                final_spans_mask_tensor = torch.cat(
-                    (final_spans_mask_tensor, spans_mask_tensor), dim=0
-                )
-        # logger.info(final_tokens_tensor)
-        # logger.info(final_attention_mask)
-        # logger.info(final_bert_spans_tensor)
-        # logger.info(final_bert_spans_tensor.shape)
-        # logger.info(final_spans_mask_tensor.shape)
-        # logger.info(final_spans_ner_label_tensor.shape)
-
-        return (
+        outputs = (
             final_tokens_tensor,
             final_attention_mask,
             final_bert_spans_tensor,
@@ -404,6 +402,9 @@ class EntityModel:
             final_spans_ner_label_tensor,
             sentence_length,
         )
+        if return_kept:
+            outputs += (kept,)
+        return outputs
 
     def run_batch(self, samples_list, try_cuda=True, training=True):
         # convert samples to input tensors
@@ -414,7 +415,10 @@ class EntityModel:
             spans_mask_tensor,
             spans_ner_label_tensor,
             sentence_length,
-        ) = self._get_input_tensors_batch(samples_list, training)
+            kept,
+        ) = self._get_input_tensors_batch(samples_list, training, return_kept=True)
+        if len(kept) == 0 and training:
+            raise AssertionError("all samples are filtered out")
 
         output_dict = {
             "ner_loss": 0,
@@ -432,34 +436,40 @@ class EntityModel:
             output_dict["ner_loss"] = ner_loss.sum()
             output_dict["ner_llh"] = F.log_softmax(ner_logits, dim=-1)
         else:
-            self.bert_model.eval()
-            with torch.no_grad():
-                ner_logits, spans_embedding, last_hidden = self.bert_model(
-                    input_ids=tokens_tensor.to(self._model_device),
-                    spans=bert_spans_tensor.to(self._model_device),
-                    spans_mask=spans_mask_tensor.to(self._model_device),
-                    spans_ner_label=None,
-                    attention_mask=attention_mask_tensor.to(self._model_device),
-                )
-            _, predicted_label = ner_logits.max(2)
-            predicted_label = predicted_label.cpu().numpy()
-            last_hidden = last_hidden.cpu().numpy()
-
+            predicted_label, ner_logits, last_hidden = None, None, None
+            if len(kept) > 0:
+                self.bert_model.eval()
+                with torch.no_grad():
+                    ner_logits, spans_embedding, last_hidden = self.bert_model(
+                        input_ids=tokens_tensor.to(self._model_device),
+                        spans=bert_spans_tensor.to(self._model_device),
+                        spans_mask=spans_mask_tensor.to(self._model_device),
+                        spans_ner_label=None,
+                        attention_mask=attention_mask_tensor.to(self._model_device),
+                    )
+                # move outputs to cpu once per batch, then slice per sample
+                ner_logits = ner_logits.cpu()
+                predicted_label = ner_logits.argmax(-1).numpy()
+                ner_logits = ner_logits.numpy()
+                last_hidden = last_hidden.cpu().numpy()
+
+            # row of each kept sample in the outputs, skipped samples have no
+            # entities (label 0 for every span)
+            rows = {i: row for row, i in enumerate(kept)}
+            hidden_dim = last_hidden.shape[-1] if last_hidden is not None else 0
             predicted = []
             pred_prob = []
             hidden = []
             for i, sample in enumerate(samples_list):
-                ner = []
-                prob = []
-                lh = []
-                for j in range(len(sample["spans"])):
-                    ner.append(predicted_label[i][j])
-                    # prob.append(F.softmax(ner_logits[i][j], dim=-1).cpu().numpy())
-                    prob.append(ner_logits[i][j].cpu().numpy())
-                    lh.append(last_hidden[i][j])
-                predicted.append(ner)
-                pred_prob.append(prob)
-                hidden.append(lh)
+                num_spans = len(sample["spans"])
+                if i in rows:
+                    predicted.append(predicted_label[rows[i], :num_spans])
+                    pred_prob.append(ner_logits[rows[i], :num_spans])
+                    hidden.append(last_hidden[rows[i], :num_spans])
+                else:
+                    predicted.append(np.zeros(num_spans, dtype=np.int64))
+                    pred_prob.append(np.zeros((num_spans, self.num_ner_labels)))
+                    hidden.append(np.zeros((num_spans, hidden_dim)))
             output_dict["pred_ner"] = predicted
             output_dict["ner_probs"] = pred_prob
             output_dict["ner_last_hidden"] = hidden
@@ -36,6 +36,67 @@ def batchify(samples, batch_size):
     return list_samples_batches
 
 
+def bucket_batchify(samples, max_tokens, max_batch_size=None, max_shared_length=350):
+    """
+    Batchify samples of similar lengths together.
+    Samples are sorted by number of tokens and spans, and a batch is closed once its
+    padded size (batch size * longest sample) would exceed `max_tokens`.
+    Samples longer than `max_shared_length` tokens are batched alone, like in
+    `batchify`: their span tensors dominate memory regardless of the token budget,
+    and a sample too long for the model then only affects itself.
+    Each sample gets a `sample_ix` field holding its position in `samples`.
+    """
+    for i, sample in enumerate(samples):
+        sample["sample_ix"] = i
+    order = sorted(
+        range(len(samples)),
+        key=lambda i: (len(samples[i]["tokens"]), len(samples[i]["spans"])),
+    )
+
+    list_samples_batches = []
+    batch = []
+    for i in order:
+        sample = samples[i]
+        if len(sample["tokens"]) > max_shared_length:
+            logger.info(
+                "Single batch sample: %s-%d", sample["doc_key"], sample["sentence_ix"]
+            )
+            list_samples_batches.append([sample])
+            continue
+        # samples are sorted, so the current one is the longest of the batch
+        padded_size = len(sample["tokens"]) * (len(batch) + 1)
+        if batch and (
+            padded_size > max_tokens
+            or (max_batch_size is not None and len(batch) >= max_batch_size)
+        ):
+            list_samples_batches.append(batch)
+            batch = []
+        batch.append(sample)
+    if batch:
+        list_samples_batches.append(batch)
+
+    assert sum([len(batch) for batch in list_samples_batches]) == len(samples)
+
+    return list_samples_batches
+
+
+def padding_efficiency(batches):
+    """
+    Ratio of real tokens / spans to padded tokens / spans over all batches
+    """
+    tokens, padded_tokens, spans, padded_spans = 0, 0, 0, 0
+    for batch in batches:
+        if len(batch) == 0:
+            continue
+        token_lengths = [len(sample["tokens"]) for sample in batch]
+        span_lengths = [len(sample["spans"]) for sample in batch]
+        tokens += sum(token_lengths)
+        padded_tokens += max(token_lengths) * len(batch)
+        spans += sum(span_lengths)
+        padded_spans += max(span_lengths) * len(batch)
+    return tokens / max(padded_tokens, 1), spans / max(padded_spans, 1)
+
+
 def overlap(s1, s2):
     if s2.start_sent >= s1.start_sent and s2.start_sent <= s1.end_sent:
         return True
@@ -45,10 +106,18 @@ def overlap(s1, s2):
 
 
 def convert_dataset_to_samples(
-    dataset, max_span_length, ner_label2id=None, context_window=0, split=0
+    dataset,
+    max_span_length,
+    ner_label2id=None,
+    context_window=0,
+    split=0,
+    inference=False,
+    prune_spans=False,
 ):
     """
     Extract sentences and gold entities from a dataset
+    inference: don't build span labels (gold entities are not needed)
+    prune_spans: skip candidate spans containing boundary punctuation
     """
     # split: split the data into train and dev (for ACE04)
     # split == 0: don't split
@@ -115,21 +184,28 @@ def convert_dataset_to_samples(
             sample["sent_end"] = sent_end
             sample["sent_start_in_doc"] = sent.sentence_start
 
-            sent_ner = {}
-            for ner in sent.ner:
-                sent_ner[ner.span.span_sent] = ner.label
-
-            span2id = {}
-            sample["spans"] = []
-            sample["spans_label"] = []
-            for i in range(len(sent.text)):
-                for j in range(i, min(len(sent.text), i + max_span_length)):
-                    sample["spans"].append((i + sent_start, j + sent_start, j - i + 1))
-                    span2id[(i, j)] = len(sample["spans"]) - 1
-                    if (i, j) not in sent_ner:
-                        sample["spans_label"].append(0)
-                    else:
-                        sample["spans_label"].append(ner_label2id[sent_ner[(i, j)]])
+            if prune_spans:
+                span_ends = get_span_ends(sent.text, max_span_length)
+            else:
+                span_ends = [
+                    min(len(sent.text), i + max_span_length)
+                    for i in range(len(sent.text))
+                ]
+
+            sample["spans"] = [
+                (i + sent_start, j + sent_start, j - i + 1)
+                for i in range(len(sent.text))
+                for j in range(i, span_ends[i])
+            ]
+            if not inference:
+                sent_ner = {}
+                for ner in sent.ner:
+                    sent_ner[ner.span.span_sent] = ner.label
+                sample["spans_label"] = [
+                    ner_label2id[sent_ner[(i, j)]] if (i, j) in sent_ner else 0
+                    for i in range(len(sent.text))
+                    for j in range(i, span_ends[i])
+                ]
             samples.append(sample)
     avg_length = sum([len(sample["tokens"]) for sample in samples]) / len(samples)
     max_length = max([len(sample["tokens"]) for sample in samples])
@@ -142,6 +218,41 @@ def convert_dataset_to_samples(
     return samples, num_ner
 
 
+# spans containing these tokens are unlikely to be entities
+BOUNDARY_PUNCTUATION = {
+    ".",
+    ",",
+    ";",
+    ":",
+    "!",
+    "?",
+    "(",
+    ")",
+    "[",
+    "]",
+    "{",
+    "}",
+    '"',
+    "``",
+    "''",
+    "--",
+}
+
+
+def get_span_ends(tokens, max_span_length):
+    """
+    For each start position i, the (exclusive) end of candidate spans starting at i:
+    spans stop before the next boundary punctuation or sentence end.
+    """
+    span_ends = [0] * len(tokens)
+    next_boundary = len(tokens)
+    for i in reversed(range(len(tokens))):
+        if tokens[i] in BOUNDARY_PUNCTUATION:
+            next_boundary = i
+        span_ends[i] = min(next_boundary, i + max_span_length)
+    return span_ends
+
+
 class NpEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.integer):
@@ -8,9 +8,14 @@ import time
 from tqdm import tqdm
 import numpy as np
 
-from shared.data_structures import Dataset
+from shared.data_structures import Dataset, Document
 from shared.const import task_ner_labels, get_labelmap
-from entity.utils import convert_dataset_to_samples, batchify, NpEncoder
+from entity.utils import (
+    convert_dataset_to_samples,
+    bucket_batchify,
+    padding_efficiency,
+    NpEncoder,
+)
 from entity.models import EntityModel
 
 from transformers import AdamW, get_linear_schedule_with_warmup
@@ -24,39 +29,64 @@ logging.basicConfig(
 logger = logging.getLogger("root")
 
 
-def output_ner_predictions(model: EntityModel, batches, dataset, output_file):
-    global ner_id2label
-
+def predict_sample_spans(model: EntityModel, batches, id2label):
     """
-    Save the prediction as a json file
+    Run the entity model over `batches` (made by `bucket_batchify`).
+    Returns the predicted spans of each sample, in the original order of samples,
+    as [start, end, label] where start and end are token indices in the sentence.
     """
-    ner_result = {}
-    span_hidden_table = {}
+    token_efficiency, span_efficiency = padding_efficiency(batches)
+    logger.info(
+        "Padding efficiency: %.3f (tokens), %.3f (spans)"
+        % (token_efficiency, span_efficiency)
+    )
+
+    results = [[] for batch in batches for _ in batch]
     tot_pred_ett = 0
     for i in range(len(batches)):
-        try:
-            output_dict = model.run_batch(batches[i], training=False)
-        except AssertionError:
-            continue
-        pred_ner = output_dict["pred_ner"]
-        for sample, preds in zip(batches[i], pred_ner):
-            off = sample["sent_start_in_doc"] - sample["sent_start"]
-            k = sample["doc_key"] + "-" + str(sample["sentence_ix"])
-            ner_result[k] = []
-            for span, pred in zip(sample["spans"], preds):
-                span_id = "%s::%d::(%d,%d)" % (
-                    sample["doc_key"],
-                    sample["sentence_ix"],
-                    span[0] + off,
-                    span[1] + off,
+        # samples too long for the model come back without entities, so
+        # `pred_ner` has one row per sample of the batch
+        output_dict = model.run_batch(batches[i], training=False)
+        for sample, preds in zip(batches[i], output_dict["pred_ner"]):
+            off = sample["sent_start"]
+            sample_spans = []
+            for j in np.flatnonzero(preds):
+                span = sample["spans"][j]
+                sample_spans.append(
+                    [span[0] - off, span[1] - off, id2label[int(preds[j])]]
                 )
-                if pred == 0:
-                    continue
-                ner_result[k].append([span[0] + off, span[1] + off, ner_id2label[pred]])
-            tot_pred_ett += len(ner_result[k])
+            results[sample["sample_ix"]] = sample_spans
+            tot_pred_ett += len(sample_spans)
 
     logger.info("Total pred entities: %d" % tot_pred_ett)
+    return results
 
+
+def predict_ner_spans(model: EntityModel, batches, id2label):
+    """
+    Returns the predicted spans of every sample, keyed by "<doc_key>-<sentence_ix>".
+    Span offsets are token indices in the document.
+    """
+    samples = sorted(
+        (sample for batch in batches for sample in batch),
+        key=lambda sample: sample["sample_ix"],
+    )
+    ner_result = {}
+    for sample, sample_spans in zip(
+        samples, predict_sample_spans(model, batches, id2label)
+    ):
+        off = int(sample["sent_start_in_doc"])
+        k = sample["doc_key"] + "-" + str(sample["sentence_ix"])
+        ner_result[k] = [
+            [start + off, end + off, label] for start, end, label in sample_spans
+        ]
+    return ner_result
+
+
+def attach_ner_predictions(dataset, ner_result):
+    """
+    Fill `predicted_ner` (and empty `predicted_relations`) of documents in `dataset.js`
+    """
     js = dataset.js
     for i, doc in enumerate(js):
         doc["predicted_ner"] = []
@@ -71,6 +101,17 @@ def output_ner_predictions(model: EntityModel, batches, dataset, output_file):
             doc["predicted_relations"].append([])
 
         js[i] = doc
+    return js
+
+
+def output_ner_predictions(model: EntityModel, batches, dataset, output_file):
+    global ner_id2label
+
+    """
+    Save the prediction as a json file
+    """
+    ner_result = predict_ner_spans(model, batches, ner_id2label)
+    js = attach_ner_predictions(dataset, ner_result)
 
     logger.info("Output predictions to %s.." % (output_file))
     with open(output_file, "a") as f:
@@ -84,8 +125,11 @@ def setseed(seed):
         torch.cuda.manual_seed_all(seed)
 
 
-def call(cmd_args=None, model_manager=None):
-    global ner_id2label, ner_label2id
+def build_arg_parser(require_io=True):
+    """
+    `require_io`: whether input / output paths are required.
+    They are not needed for in-process inference.
+    """
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -99,7 +143,7 @@ def call(cmd_args=None, model_manager=None):
         "--test_data",
         type=str,
         default=None,
-        required=True,
+        required=require_io,
         help="path to the preprocessed dataset",
     )
     parser.add_argument(
@@ -119,7 +163,7 @@ def call(cmd_args=None, model_manager=None):
         "--output_dir",
         type=str,
         default=None,
-        required=True,
+        required=require_io,
         help="directory for log outputs",
     )
 
@@ -131,9 +175,21 @@ def call(cmd_args=None, model_manager=None):
         help="spans w/ length up to max_span_length are considered as candidates",
     )
 
+    parser.add_argument(
+        "--prune_spans",
+        action="store_true",
+        help="skip candidate spans containing punctuation such as commas or periods",
+    )
+
     parser.add_argument(
         "--eval_batch_size", type=int, default=32, help="batch size during inference"
     )
+    parser.add_argument(
+        "--eval_max_tokens",
+        type=int,
+        default=8192,
+        help="maximum number of padded input tokens (words) in a batch during inference",
+    )
     parser.add_argument(
         "--eval_per_epoch",
         type=int,
@@ -168,14 +224,127 @@ def call(cmd_args=None, model_manager=None):
         default=300,
         help="the context window size W for the entity model",
     )
+    return parser
 
-    args = parser.parse_args(cmd_args)
 
-    if "albert" in args.model:
-        logger.info("Use Albert: %s" % args.model)
-        args.use_albert = True
+def load_entity_model(args, num_ner_labels, model_manager=None):
+    model = None
+    if model_manager is not None:
+        model = model_manager.get_preloaded_model("ner")
+    if model is None:
+        model = EntityModel(args, num_ner_labels=num_ner_labels)
+        if model_manager is not None:
+            model_manager.save_preloaded_model("ner", model)
+    return model
+
+
+class NEREngine:
+    """
+    Resident entity model for in-process inference.
+    Documents are passed in as lists of tokenized sentences and predictions are
+    returned directly, without input / output files.
+    """
+
+    def __init__(self, args, model_manager=None):
+        if "albert" in args.model:
+            logger.info("Use Albert: %s" % args.model)
+            args.use_albert = True
+        args.bert_model_dir = args.model_dir
+        setseed(args.seed)
+
+        self.args = args
+        self.ner_label2id, self.ner_id2label = get_labelmap(
+            task_ner_labels[args.task]
+        )
+        num_ner_labels = len(task_ner_labels[args.task]) + 1
+        self.model = load_entity_model(args, num_ner_labels, model_manager)
+
+    def _convert_to_samples(self, dataset):
+        samples, _ = convert_dataset_to_samples(
+            dataset,
+            self.args.max_span_length,
+            ner_label2id=self.ner_label2id,
+            context_window=self.args.context_window,
+            inference=True,
+            prune_spans=self.args.prune_spans,
+        )
+        return samples
+
+    def _batchify(self, samples):
+        return bucket_batchify(
+            samples, self.args.eval_max_tokens, self.args.eval_batch_size
+        )
+
+    def predict_dataset(self, dataset):
+        """
+        Predict entities for all documents in `dataset`.
+        Returns `dataset.js` with `predicted_ner` filled.
+        """
+        batches = self._batchify(self._convert_to_samples(dataset))
+        ner_result = predict_ner_spans(self.model, batches, self.ner_id2label)
+        return attach_ner_predictions(dataset, ner_result)
+
+    def build_samples(self, documents):
+        """
+        `documents`: a list of documents, each is a list of tokenized sentences.
+        Returns one sample (a sentence with its context) per sentence.
+        `doc_key` of a sample is the index of its document.
+        """
+        js = [
+            {"doc_key": str(i), "sentences": sentences}
+            for i, sentences in enumerate(documents)
+            if len(sentences) > 0
+        ]
+        if len(js) == 0:
+            return []
+        dataset = Dataset(documents=[Document(doc) for doc in js], js=js)
+        return self._convert_to_samples(dataset)
+
+    def predict_samples(self, samples):
+        """
+        Returns the predicted entities of each sample as [start, end, label],
+        where start and end are token indices in the sentence.
+        """
+        if len(samples) == 0:
+            return []
+        return predict_sample_spans(
+            self.model, self._batchify(samples), self.ner_id2label
+        )
+
+    @staticmethod
+    def collect_document_predictions(documents, samples, sample_spans):
+        """
+        Convert predictions of samples back to the `predicted_ner` of each document.
+        """
+        outputs = [[[] for _ in sentences] for sentences in documents]
+        for sample, spans in zip(samples, sample_spans):
+            off = int(sample["sent_start_in_doc"])
+            outputs[int(sample["doc_key"])][sample["sentence_ix"]] = [
+                [start + off, end + off, label] for start, end, label in spans
+            ]
+        return outputs
+
+    def predict(self, documents):
+        """
+        `documents`: a list of documents, each is a list of tokenized sentences.
+        Returns the `predicted_ner` of each document: for each sentence, a list of
+        [start, end, label] where start and end are token indices in the document.
+        """
+        samples = self.build_samples(documents)
+        return self.collect_document_predictions(
+            documents, samples, self.predict_samples(samples)
+        )
+
+
+def create_engine(cmd_args=None, model_manager=None):
+    args = build_arg_parser(require_io=False).parse_args(cmd_args)
+    logger.info(args)
+    return NEREngine(args, model_manager)
 
-    setseed(args.seed)
+
+def call(cmd_args=None, model_manager=None):
+    global ner_id2label, ner_label2id
+    args = build_arg_parser().parse_args(cmd_args)
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
@@ -187,18 +356,8 @@ def call(cmd_args=None, model_manager=None):
     logger.info(sys.argv)
     logger.info(args)
 
-    ner_label2id, ner_id2label = get_labelmap(task_ner_labels[args.task])
-
-    num_ner_labels = len(task_ner_labels[args.task]) + 1
-    args.bert_model_dir = args.model_dir
-
-    model = None
-    if model_manager is not None:
-        model = model_manager.get_preloaded_model("ner")
-    if model is None:
-        model = EntityModel(args, num_ner_labels=num_ner_labels)
-        if model_manager is not None:
-            model_manager.save_preloaded_model("ner", model)
+    engine = NEREngine(args, model_manager)
+    ner_label2id, ner_id2label = engine.ner_label2id, engine.ner_id2label
 
     test_data = Dataset(args.test_data)
     prediction_file = args.test_pred_filename
@@ -213,10 +372,14 @@ def call(cmd_args=None, model_manager=None):
             args.max_span_length,
             ner_label2id=ner_label2id,
             context_window=args.context_window,
+            inference=True,
+            prune_spans=args.prune_spans,
+        )
+        test_batches = bucket_batchify(
+            test_samples, args.eval_max_tokens, args.eval_batch_size
         )
-        test_batches = batchify(test_samples, args.eval_batch_size)
         output_ner_predictions(
-            model, test_batches, test_data, output_file=prediction_file
+            engine.model, test_batches, test_data, output_file=prediction_file
         )
 
 
@@ -1,12 +1,19 @@
 import sqlite3
+from collections import OrderedDict
 from dataclasses import is_dataclass
 import functools
+import hashlib
+import json
 import logging
 import importlib.util
 import sys
 import re
 from pathlib import Path
 import time
+import queue
+import random
+import threading
+from concurrent.futures import Future
 from contextlib import contextmanager
 
 try:
@@ -102,7 +109,11 @@ def es_request(method, path, **kwargs):
     return requests.request(method, url, auth=Config.es_auth, verify=False, **kwargs)
 
 
-def es_cache(key):
+def es_cache(key, should_cache=None):
+    """
+    `should_cache`: called with the result, it's not cached if this returns False
+    """
+
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
@@ -127,6 +138,9 @@ def es_cache(key):
             logging.info("cache not hit, computing")
             result = func(*args, **kwargs)
             result = dictify(result)
+            if should_cache is not None and not should_cache(result):
+                logging.info("result not cached, key: %s", key)
+                return result
             doc_id = g.doc["id"]
             try:
                 es_writeback(g.collection, doc_id, key, result, arg_cache_key)
@@ -170,16 +184,16 @@ def es_writeback(coll, doc_id, key, value, subkey=None):
 def dictify(obj):
     """
     Convert a list(-of) / dict(-of) dataclasses or primitive types to a dictionary.
+    Other objects are converted if they implement `asdict`.
     """
     if isinstance(obj, dict):
         return {k: dictify(v) for k, v in obj.items()}
     elif isinstance(obj, list):
         return [dictify(v) for v in obj]
+    elif hasattr(obj, "asdict"):
+        return obj.asdict()  # assume custom asdict is implemented
     elif is_dataclass(obj):
-        if hasattr(obj, "asdict"):
-            return obj.asdict()  # assume custom asdict is implemented
-        else:
-            return asdict(obj)
+        return asdict(obj)
     else:
         return obj
 
@@ -214,15 +228,269 @@ def dynamic_import(file_path, attr=None, register=False):
         return getattr(module, attr)
 
 
+def content_hash(*parts) -> str:
+    """
+    Stable hash of JSON-serializable values, used as content-addressed cache keys.
+    """
+    serialized = json.dumps(parts, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-process cache with least-recently-used eviction.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def put_many(self, items):
+        with self._lock:
+            for key, value in items:
+                self._put(key, value)
+
+    def _put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache(LRUCache):
+    """
+    `LRUCache` in front of a table of a local SQLite database, so entries outlive
+    the process. Values are stored as JSON. If the database can't be used, the
+    error is logged and only the in-memory cache is used.
+    """
+
+    def __init__(self, path, table, maxsize=1024):
+        super().__init__(maxsize)
+        self.path = path
+        self.table = table
+        self._db = None
+
+    def _conn(self):
+        # only used with the lock held, so the connection can be shared by threads
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} "
+                "(key text primary key, value text)"
+            )
+        return self._db
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            try:
+                row = (
+                    self._conn()
+                    .execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,))
+                    .fetchone()
+                )
+            except sqlite3.Error:
+                logging.exception("Failed to read %s from %s", key, self.path)
+                row = None
+            if row is None:
+                self.misses += 1
+                return default
+            value = json.loads(row[0])
+            self._put(key, value)
+            self.hits += 1
+            return value
+
+    def put_many(self, items):
+        items = list(items)
+        with self._lock:
+            for key, value in items:
+                self._put(key, value)
+            try:
+                with self._conn() as con:
+                    con.executemany(
+                        f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?)",
+                        [(key, json.dumps(value)) for key, value in items],
+                    )
+            except sqlite3.Error:
+                logging.exception("Failed to write to %s", self.path)
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+
+class StageTimer:
+    """
+    Wall time and number of items accumulated per processing stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._seconds = OrderedDict()
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self, stage, items=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._seconds[stage] = self._seconds.get(stage, 0.0) + elapsed
+                self._items[stage] = self._items.get(stage, 0) + items
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                stage: {"seconds": seconds, "items": self._items[stage]}
+                for stage, seconds in self._seconds.items()
+            }
+
+    def log(self, logger, level=logging.INFO, since=None):
+        """
+        `since`: an earlier `snapshot()`, only the time spent after it is logged.
+        """
+        if not logger.isEnabledFor(level):
+            return
+        timings = self.snapshot()
+        if since is not None:
+            timings = {
+                stage: {
+                    key: x[key] - since.get(stage, {}).get(key, 0)
+                    for key in ("seconds", "items")
+                }
+                for stage, x in timings.items()
+            }
+            timings = {stage: x for stage, x in timings.items() if x["items"]}
+        stages = ", ".join(
+            f"{stage} {x['seconds']:.3f}s/{x['items']}" for stage, x in timings.items()
+        )
+        label = "total seconds/items" if since is None else "seconds/items"
+        logger.log(level, "%s timings (%s): %s", self.name, label, stages)
+
+
+def log_sampled(logger, rate, msg, *args):
+    """
+    Log a debug message for a random `rate` fraction of the calls.
+    """
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < rate:
+        logger.debug(msg, *args)
+
+
+class MicroBatcher:
+    """
+    Gathers items submitted from concurrent threads and processes them together.
+
+    A batch is closed `window` seconds after its first item arrives, or earlier if
+    adding the next item would exceed `max_size` (measured by `size_of`).
+    `process_batch` takes a list of items and returns a list of results in the
+    same order. It always runs on the same background thread, so models used
+    inside it are never called concurrently. If a batch fails, its items are
+    processed again one by one, so an exception only reaches the items causing it.
+    """
+
+    def __init__(self, process_batch, window=0.05, max_size=None, size_of=len):
+        self.process_batch = process_batch
+        self.window = window
+        self.max_size = max_size
+        self.size_of = size_of
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        """
+        Blocks until the batch containing `item` is processed and returns its result.
+        """
+        future = Future()
+        self._queue.put((item, future))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+        return future.result()
+
+    def _loop(self):
+        carry = None
+        while True:
+            if carry is None:
+                carry = self._queue.get()
+            pending = [carry]
+            size = self.size_of(carry[0])
+            carry = None
+            deadline = time.monotonic() + self.window
+            while self.max_size is None or size < self.max_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                entry_size = self.size_of(entry[0])
+                if self.max_size is not None and size + entry_size > self.max_size:
+                    carry = entry
+                    break
+                pending.append(entry)
+                size += entry_size
+            self._process(pending, size)
+
+    def _process(self, pending, size):
+        logging.info("Processing micro-batch: %d items, size %d", len(pending), size)
+        try:
+            results = self.process_batch([item for item, _ in pending])
+        except Exception as e:
+            if len(pending) == 1:
+                pending[0][1].set_exception(e)
+                return
+            # one bad item shouldn't fail the others, retry them one by one
+            logging.exception("Micro-batch failed, processing items separately")
+            for entry in pending:
+                self._process([entry], self.size_of(entry[0]))
+            return
+        for (_, future), result in zip(pending, results):
+            future.set_result(result)
+
+
 class Models:
     """
     Lazy loading models
     """
 
     _nlp = None
+    _sentence_pipeline = None
     _sentence_transformer = None
     _vader = None
     _embedding_db = None
+    _entity_embedding_matrix = None
+    _entity_ann_index = None
     _loaded_models = {}
 
     # @property & @classmethod do not work together
@@ -245,6 +513,22 @@ class Models:
             print("done")
         return cls._nlp(*args, **kwargs)
 
+    @classmethod
+    def sentence_pipeline(cls):
+        """
+        SpaCy pipeline for sentence segmentation and POS tagging only.
+        Components that are not needed (NER, lemmatizer) are not loaded.
+        """
+        if cls._sentence_pipeline is None:
+            print("Loading SpaCy sentence pipeline...")
+            import spacy
+
+            cls._sentence_pipeline = spacy.load(
+                "en_core_web_sm", exclude=["ner", "lemmatizer"]
+            )
+            print("done")
+        return cls._sentence_pipeline
+
     @classmethod
     def encode_sentence(cls, *args, **kwargs):
         if cls._sentence_transformer is None:
@@ -288,6 +572,51 @@ class Models:
             )
         return cls._embedding_db
 
+    @classmethod
+    def get_entity_embedding_matrix(cls):
+        """
+        (sorted entity ids, embedding matrix), both memory-mapped read-only and
+        shared by all worker processes, or None if the matrix has not been built.
+        A rebuilt matrix is picked up when the worker restarts.
+        """
+        if cls._entity_embedding_matrix is None:
+            import numpy as np
+
+            try:
+                ids = np.load(Config.entity_embedding_ids, mmap_mode="r")
+                matrix = np.load(Config.entity_embedding_matrix, mmap_mode="r")
+                cls._entity_embedding_matrix = (ids, matrix) if len(ids) else ()
+            except FileNotFoundError:
+                logging.warning("Entity embedding matrix not found, using SQLite")
+                cls._entity_embedding_matrix = ()
+        return cls._entity_embedding_matrix or None
+
+    @classmethod
+    def get_entity_ann_index(cls):
+        """
+        faiss index over the entity embedding matrix, or None if faiss is not
+        installed or the index has not been built for the current matrix.
+        """
+        if cls._entity_ann_index is None:
+            cls._entity_ann_index = ()
+            matrix = cls.get_entity_embedding_matrix()
+            if matrix is None or not Path(Config.entity_ann_index).exists():
+                return None
+            try:
+                import faiss
+            except ImportError:
+                logging.warning("faiss is not installed, ANN index is not used")
+                return None
+            index = faiss.read_index(Config.entity_ann_index)
+            if index.ntotal != len(matrix[0]):
+                logging.warning("ANN index is outdated, rebuild it")
+                return None
+            faiss.ParameterSpace().set_index_parameter(
+                index, "efSearch", Config.entity_ann_ef_search
+            )
+            cls._entity_ann_index = index
+        return cls._entity_ann_index or None
+
     @classmethod
     def get_preloaded_model(cls, name):
         return cls._loaded_models.get(name)
@@ -14,7 +14,16 @@ import re
 import json
 
 from celery import chain as celery_chain, group as celery_group, Signature
-from flask import Flask, Blueprint, jsonify as flask_jsonify, request, g, current_app
+from flask import (
+    Flask,
+    Blueprint,
+    Response,
+    jsonify as flask_jsonify,
+    request,
+    g,
+    current_app,
+    stream_with_context,
+)
 from flask_cors import CORS
 from neo4j import GraphDatabase
 
@@ -202,6 +211,19 @@ def api_semantic_parse_document(collection, doc_id):
     return jsonify(api_impl.semantic_parse_document())
 
 
+@doc_api.route("/<collection>/doc/<doc_id>/semantic/stream")
+def api_semantic_parse_document_stream(collection, doc_id):
+    """
+    Same as /semantic, one JSON object per line, sent as sentences are decoded.
+    """
+
+    def generate():
+        for item in api_impl.semantic_parse_document_stream():
+            yield json.dumps(dictify(item)) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
 @doc_api.route("/<collection>/doc/<doc_id>/person_relation")
 def api_extract_person_relations(collection, doc_id):
     return flask_jsonify(api_impl.extract_person_relations())
@@ -447,9 +469,9 @@ def api_batch_submit(collection):
     batch_memo = request.json.get("memo", "Unnamed")
     chains = background.get_task_chains(tasks)
 
+    doc_ids = [doc["_id"] for doc in es_resp["hits"]["hits"]]
     batch_tasks = []
-    for doc in es_resp["hits"]["hits"]:
-        doc_id = doc["_id"]
+    for doc_id in doc_ids:
         doc_chains = []
         for chain in chains:
             sigs = [
@@ -466,8 +488,22 @@ def api_batch_submit(collection):
             ]
             doc_chains.append(celery_chain(*sigs))
         batch_tasks.append(celery_group(*doc_chains, ignore_result=True))
+    if background.needs_tokenization(tasks):
+        # segment the documents in chunks, each chunk in one pass before the
+        # tasks of its own documents
+        size = Config.tokenization_chunk_size
+        batch_tasks = [
+            celery_chain(
+                background.precompute_tokenization.si(
+                    g.collection, doc_ids[i : i + size]
+                ),
+                celery_group(*batch_tasks[i : i + size], ignore_result=True),
+            )
+            for i in range(0, len(doc_ids), size)
+        ]
+    batch_job = celery_group(*batch_tasks, ignore_result=True)
     # start the whole batch
-    celery_group(*batch_tasks, ignore_result=True).apply_async(ignore_result=True)
+    batch_job.apply_async(ignore_result=True)
     return flask_jsonify(
         {
             "num_docs": num_docs,